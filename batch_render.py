@@ -0,0 +1,129 @@
+"""複数のCSVからレポート画像を一括で出力する（Streamlit を使わない）
+
+アプリと同じフォルダで実行し、アプリの設定（app_state.db の看板の文字・対象機種・
+仕掛けの内容）と機種画像を読み込む。背景色は各レポートの既定色。
+
+    python batch_render.py CSVのフォルダ -o 出力フォルダ [--workers 4] [--reports 1,2,5]
+                           [--shikake 仕掛けの台番指定.json] [--format WebP] [--width 1080] [--history]
+                           [--page-height 4000] [--page-rows 30]
+
+仕掛けの台番指定は 7 つの指定式（例: "101-140, 末尾7"）を並べた JSON 配列。
+指定が無い場合、レポート3は出力しない。
+--page-height / --page-rows を指定すると、縦に長いレポートを看板付きのページに分けて書き出す。
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import report_core as core
+
+REPORT_IDS = ["1", "2", "3", "4", "5"]
+HISTORY_RESULTS = {"added": "追加", "same_csv": "取り込み済み", "day_exists": "同じ日の別のCSVが取り込み済み"}
+
+def render_job(csv_path, sid, spec, out_dir, fmt="PNG", width=None, page=None):
+    """1つのCSV・1つのレポートを描画して保存する（ワーカープロセスで実行）。
+    page を指定するとページごとに描いて {名前}_p01 … として書き出し、最初のファイル名を返す"""
+    t0 = time.perf_counter()
+    with open(csv_path, "rb") as f:
+        bundle = core.get_csv_bundle(f.read())
+    stem = os.path.join(out_dir, f"{os.path.splitext(os.path.basename(csv_path))[0]}_report{sid}")
+    ext = core.OUTPUT_FORMATS[fmt][0]
+    out_path = None
+    if page:
+        for n, img in enumerate(core.iter_report_pages(sid, bundle, spec, page), 1):
+            path = f"{stem}_p{n:02d}.{ext}"
+            with open(path, "wb") as f:
+                f.write(core.encode_report_image(img, fmt, width))
+            out_path = out_path or path
+    else:
+        img = core.render_report(sid, bundle, spec)
+        if img is not None:
+            out_path = f"{stem}.{ext}"
+            with open(out_path, "wb") as f:
+                f.write(core.encode_report_image(img, fmt, width))
+    return csv_path, sid, out_path, time.perf_counter() - t0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CSVのフォルダからレポート画像を一括出力する")
+    parser.add_argument("csv_dir", help="CSVファイルを置いたフォルダ")
+    parser.add_argument("-o", "--out", default="output", help="画像の出力先フォルダ")
+    parser.add_argument("--format", default="PNG", choices=list(core.OUTPUT_FORMATS), help="画像の形式")
+    parser.add_argument("--width", type=int, help="出力する横幅（px）。省略時は元のサイズ")
+    parser.add_argument("--page-height", type=int, help="ページに分けて出力する。1ページの高さの上限（px）")
+    parser.add_argument("--page-rows", type=int, help="ページに分けて出力する。1ページの表の行数の上限")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="プロセス数")
+    parser.add_argument("--reports", default=",".join(REPORT_IDS), help="出力するレポート（カンマ区切り）")
+    parser.add_argument("--shikake", help="仕掛け1〜7の台番指定（JSON 配列）")
+    parser.add_argument("--history", action="store_true",
+                        help="CSVを日ごとの履歴にも取り込む（営業日はファイル名の日付。日付の無いファイルは取り込まない）")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    csv_paths = sorted(glob.glob(os.path.join(args.csv_dir, "*.csv")))
+    if not csv_paths:
+        parser.error(f"CSVが見つかりません: {args.csv_dir}")
+    os.makedirs(args.out, exist_ok=True)
+
+    selectors = None
+    if args.shikake:
+        with open(args.shikake, "r", encoding="utf-8") as f:
+            selectors = (list(json.load(f)) + [""] * 7)[:7]
+    report_ids = [sid.strip() for sid in args.reports.split(",") if sid.strip() in REPORT_IDS]
+    if "3" in report_ids and not selectors:
+        logging.info("レポート3: 仕掛けの台番指定（--shikake）が無いため出力しません")
+        report_ids.remove("3")
+    specs = {sid: core.load_report_spec(sid, selectors) for sid in report_ids}
+    page = {"max_height": args.page_height, "max_rows": args.page_rows} if args.page_height or args.page_rows else None
+
+    if args.history:
+        for path in csv_paths:
+            name = os.path.basename(path)
+            if core.history_store.day_from_filename(name) is None:
+                logging.info(f"履歴: {name} はファイル名に日付が無いため取り込みません")
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            day, result = core.add_to_history(core.get_csv_bundle(data), hashlib.sha1(data).hexdigest(), name)
+            logging.info(f"履歴: {name} → {day}（{HISTORY_RESULTS[result]}）")
+
+    t0 = time.perf_counter()
+    done, skipped, failed = [], 0, 0
+    # matplotlib はスレッドセーフではないため、並列化はプロセス単位で行う。
+    # 親プロセスで開いた SQLite の接続を fork で引き継がないよう spawn で起動する
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(render_job, path, sid, specs[sid], args.out, args.format, args.width, page): (path, sid)
+                   for path in csv_paths for sid in report_ids}
+        for fut in as_completed(futures):
+            path, sid = futures[fut]
+            try:
+                _, _, out_path, elapsed = fut.result()
+            except Exception as e:
+                failed += 1
+                logging.error(f"失敗: {os.path.basename(path)} レポート{sid}: {e}")
+                continue
+            if out_path is None:
+                skipped += 1
+                logging.info(f"対象なし: {os.path.basename(path)} レポート{sid}")
+            else:
+                done.append((sid, elapsed))
+                logging.info(f"出力: {out_path}（{elapsed:.2f}秒）")
+    wall = time.perf_counter() - t0
+
+    logging.info("")
+    logging.info(f"CSV {len(csv_paths)}件 / 画像 {len(done)}枚 / 対象なし {skipped} / 失敗 {failed}")
+    logging.info(f"経過時間 {wall:.2f}秒（{len(done) / wall if wall else 0:.2f}枚/秒・{len(csv_paths) / wall if wall else 0:.2f}CSV/秒、"
+                 f"{args.workers}プロセス）")
+    for sid in report_ids:
+        times = [e for s, e in done if s == sid]
+        if times:
+            logging.info(f"  レポート{sid}: {len(times)}枚・平均 {sum(times) / len(times):.2f}秒")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
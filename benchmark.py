@@ -0,0 +1,337 @@
+"""レポート作成の処理時間とメモリ使用量を、ホールの規模を変えて測る（Streamlit を使わない）
+
+合成したCSV（機種名・台番・差枚・G数・BB・RB・ART）を台数と文字コードを変えて作り、
+段階ごと（CSVの読み込み・インデックス作成・対象の抽出・表の行の整形・表の描画・合成・PNG 変換）の時間と
+ピークメモリを測って JSON に書き出す。以前の結果と比べて遅くなった段階を表示することもできる。
+
+    python benchmark.py [--sizes 200,1000,5000,20000] [--encodings cp932,utf-8] [--repeat 3]
+                        [-o benchmark.json] [--compare 前回の結果.json] [--keep-csv 保存先フォルダ]
+    python benchmark.py --check-tables
+
+--check-tables は測定の代わりに、Pillow と matplotlib で描いた表の画像の大きさが同じかを確かめる
+（区切り行で表が図からはみ出す 200 行超の表を含む）。
+
+1つの条件（台数×文字コード）ごとに新しいプロセスで測るので、ピークメモリは条件ごとの値になる。
+設定やキャッシュは一時フォルダに作り、アプリのフォルダのものは使わない。
+"""
+import argparse
+import datetime
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SIZES = [200, 1000, 5000, 20000]
+ENCODINGS = ["cp932", "utf-8"]
+STAGES = ["parse", "index", "filter", "format", "draw_machine_table", "draw_table_image", "composite", "encode"]
+TARGET_COUNT = 3        # レポート1/2と同じく上位3機種を対象にする
+TARGET_THRESHOLD = 1000
+
+# 機種名の元（実際のCSVに近い表記。cp932 で書ける文字だけ）
+MACHINE_BASES = [
+    "スーパーブラックジャック", "Bニューパルサー", "バーニングエクスプレス", "北斗 転生の章2", "モンスターハンターライズ",
+    "革命機ヴァルヴレイヴ2", "押忍!番長4", "ドルアーガの塔", "バキ 強くなりたくば喰らえ!!!", "東京喰種",
+    "沖ドキ!DUO", "いざ!番長", "戦国乙女4", "南国育ち", "転生したら剣でした", "ゴッドイーター リザレクション",
+    "ようこそ実力至上主義の教室へ", "アリフレ", "炎炎ノ消防隊", "ルパン三世", "エウレカセブンAO", "バジリスク絆2 天膳",
+    "ハナビ", "クランキークレスト", "モンキーターンV", "ゴジラ", "ヱヴァンゲリヲン", "からくりサーカス",
+    "スマスロ 緑ドン", "化物語", "まどか☆マギカ", "ディスクアップ2", "ガールズ&パンツァー", "チバリヨ2",
+]
+JUGGLERS = ["マイジャグラーV", "アイムジャグラーEX", "ファンキージャグラー2KT", "ハッピージャグラーVIII",
+            "ゴーゴージャグラー3", "ジャグラーガールズSS", "ミラクルジャグラー", "ウルトラミラクルジャグラー"]
+PREFIXES = ["L", "L", "S", "", "パチスロ"]
+
+# ==========================================
+# 合成データの作成
+# ==========================================
+def machine_names(rng, n_models):
+    """機種名を n_models 個作る（ジャグラー系は必ず入れる）"""
+    names = list(JUGGLERS)
+    suffixes = ["", "", "2", "3", " ZERO", " RISE", "V", " 新装版"]
+    while len(names) < n_models:
+        name = f"{rng.choice(PREFIXES)}{rng.choice(MACHINE_BASES)}{rng.choice(suffixes)}"
+        if name not in names:
+            names.append(name)
+        elif len(names) >= len(JUGGLERS) + len(MACHINE_BASES) * 8:
+            names.append(f"{name} {len(names)}")
+    return names[:n_models]
+
+def generate_hall(n_machines, seed=0):
+    """n_machines 台分の1日の出力を作る。機種ごとの台数は上位に偏らせ（ジャグラーの島は大きい）、
+    同じ機種は台番が続くように並べる。差枚は G数が多いほどばらつく"""
+    rng = np.random.default_rng(seed + n_machines)
+    n_models = max(10, n_machines // 8)
+    names = machine_names(rng, n_models)
+    weights = 1.0 / np.arange(1, n_models + 1) ** 0.9
+    counts = np.maximum(1, np.round(weights / weights.sum() * n_machines)).astype(int)
+    counts[0] += n_machines - counts.sum()
+    if counts[0] < 1:
+        counts = np.maximum(1, counts)
+        while counts.sum() > n_machines:
+            counts[np.argmax(counts)] -= 1
+    m_names = np.repeat(np.array(names, dtype=object), counts)
+
+    # 台番は 1 から。末尾4 を欠番にするホールも多い
+    numbers = np.arange(1, n_machines * 2)
+    if seed % 2 == 0:
+        numbers = numbers[numbers % 10 != 4]
+    numbers = numbers[:n_machines]
+
+    idle = rng.random(n_machines) < 0.1
+    games = np.where(idle, rng.integers(0, 300, n_machines),
+                     np.clip(rng.gamma(2.5, 1800, n_machines), 0, 12000)).astype(int)
+    bb = rng.poisson(games / 280)
+    rb = rng.poisson(games / 400)
+    art = rng.poisson(games / 600)
+    diff = np.round(rng.normal(-0.05 * games, 25 * np.sqrt(games) + 50)).astype(int)
+    total = bb + rb
+    prob = np.where(total > 0, np.char.add("1/", (games // np.maximum(total, 1)).astype(str)), "-")
+    return {"台番": numbers, "機種名": m_names, "G数": games, "BB": bb, "RB": rb, "ART": art,
+            "差枚": diff, "合成確率": prob}
+
+def hall_to_csv(hall, encoding):
+    import pandas as pd
+    buf = io.StringIO()
+    pd.DataFrame(hall).to_csv(buf, index=False)
+    return buf.getvalue().encode(encoding)
+
+def synthetic_photo(seed=0):
+    """機種画像の代わり（写真に近いサイズとばらつきのある画像）"""
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:960, 0:1280]
+    base = np.stack([x * 255 // 1280, y * 255 // 960, (x + y) * 255 // 2240], axis=2)
+    noise = rng.integers(0, 16, base.shape)
+    img = Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8), "RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+# ==========================================
+# 計測
+# ==========================================
+def max_rss_mb():
+    """プロセスのピークメモリ（MB）。resource の無い環境（Windows）では None"""
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+    except:
+        return None
+
+class StageTimer:
+    """段階ごとの経過時間と、その段階を終えた時点のピークメモリを記録する"""
+    def __init__(self):
+        self.seconds = {}
+        self.max_rss_mb = {}
+
+    def run(self, stage, func, *args):
+        t0 = time.perf_counter()
+        result = func(*args)
+        self.seconds[stage] = time.perf_counter() - t0
+        self.max_rss_mb[stage] = max_rss_mb()
+        return result
+
+def run_once(core, data, photo_digest):
+    """1回分。キャッシュを空にしてから全段階を通す"""
+    for cache in (core.get_table_cache(), core.get_banner_cache(), core.get_resized_cache()):
+        cache.clear()
+    timer = StageTimer()
+    bundle = timer.run("parse", core.parse_csv_bytes, data)
+    cols = bundle["cols"]
+
+    def build_indexes():
+        bundle["machine_index"] = core.build_machine_index(bundle["df"], cols["m_name"], cols["number"], cols["diff"])
+        bundle["number_index"] = core.build_number_index(bundle["df"], cols["number"], cols["m_name"])
+    timer.run("index", build_indexes)
+
+    counts = bundle["df"][cols["m_name"]].value_counts()
+    targets = [(str(name), str(name), TARGET_THRESHOLD) for name in counts.index[:TARGET_COUNT]]
+    selected = timer.run("filter", lambda: list(core.select_targets(bundle["machine_index"], targets, cols["number"])))
+
+    def format_rows():
+        sections = []
+        for dn, e_df in selected:
+            rows = [[f"{dn} 優秀台"] * 7, list(core.TABLE_HEADER)]
+            rows.extend(core.build_table_rows(e_df, cols["number"], cols["diff"], dn))
+            sections.append((dn, rows))
+        return sections
+    sections = timer.run("format", format_rows)
+
+    color = core.FILES["1"]["color"]
+    timer.run("draw_machine_table", lambda: [core.draw_machine_table(rows, color) for _, rows in sections])
+    top10_rows, h_idx = core.build_top10_rows(bundle, "差枚数TOP10")
+    timer.run("draw_table_image", core.draw_table_image, top10_rows, h_idx, color, "差枚数TOP10", "5")
+    # 表は直前の段階でキャッシュに入っているので、ここは看板・機種画像の縮小・貼り合わせの時間
+    img = timer.run("composite", core.draw_report_with_machine_images, sections, color, "週間おススメ機種",
+                    {dn: photo_digest for dn, _ in sections})
+    encoded = timer.run("encode", core.encode_report_image, img)
+    return timer, {"rows": len(bundle["df"]), "targets": len(sections),
+                   "table_rows": sum(len(rows) for _, rows in sections),
+                   "report_px": list(img.size), "png_bytes": len(encoded)}
+
+def run_case(n_machines, encoding, repeat, keep_csv=None):
+    """1つの条件を新しいプロセスで測る（multiprocessing の spawn で呼ばれる）"""
+    # フォントと置換辞書は実行したフォルダ（アプリのフォルダ）のものを使い、設定やキャッシュは一時フォルダに作る
+    t0 = time.perf_counter()
+    import report_core as core
+    import_seconds = time.perf_counter() - t0
+    core.RENAME_FILE = os.path.abspath(core.RENAME_FILE)  # 下で一時フォルダに移るので絶対パスにしておく
+    cwd = os.getcwd()
+    # 一時フォルダは条件ごとに作って消す（Windows では開いたままの DB が消せないことがあるので、その場合は残す）
+    with tempfile.TemporaryDirectory(prefix="report_bench_", ignore_cleanup_errors=True) as work_dir:
+        os.chdir(work_dir)
+        try:
+            return _measure_case(core, n_machines, encoding, repeat, keep_csv, import_seconds)
+        finally:
+            os.chdir(cwd)
+
+def _measure_case(core, n_machines, encoding, repeat, keep_csv, import_seconds):
+    core.load_font(10, "")  # サブセットフォントは最初の1回だけ作るので、計測の前に済ませておく
+    data = hall_to_csv(generate_hall(n_machines), encoding)
+    if keep_csv:
+        with open(os.path.join(keep_csv, f"hall_{n_machines}_{encoding}.csv"), "wb") as f:
+            f.write(data)
+    photo = core.put_image_blob(synthetic_photo())
+    baseline = max_rss_mb()
+    runs, info = [], None
+    for _ in range(repeat):
+        timer, info = run_once(core, data, photo)
+        runs.append(timer)
+    stages = {}
+    for stage in STAGES:
+        times = sorted(r.seconds[stage] for r in runs)
+        stages[stage] = {"min": times[0], "median": times[len(times) // 2], "runs": [r.seconds[stage] for r in runs],
+                         "max_rss_mb": max((r.max_rss_mb[stage] for r in runs if r.max_rss_mb[stage] is not None), default=None)}
+    return {"machines": n_machines, "encoding": encoding, "csv_bytes": len(data), "import_seconds": import_seconds,
+            "baseline_rss_mb": baseline, "peak_rss_mb": max_rss_mb(),
+            "total_median": sum(s["median"] for s in stages.values()), "stages": stages, **info}
+
+def environment():
+    import pandas as pd
+    import PIL
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "pandas": pd.__version__, "pillow": PIL.__version__,
+            "numpy": np.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "table_renderer": os.environ.get("TABLE_RENDERER", "pillow"),
+            "started_at": datetime.datetime.now().isoformat(timespec="seconds")}
+
+# ==========================================
+# 結果の表示と比較
+# ==========================================
+def case_key(case):
+    return f"{case['machines']}台/{case['encoding']}"
+
+def log_case(case):
+    stages = "  ".join(f"{s} {case['stages'][s]['median'] * 1000:.0f}ms" for s in STAGES)
+    peak = f"{case['peak_rss_mb']:.0f}MB" if case["peak_rss_mb"] is not None else "不明"
+    logging.info(f"{case_key(case)}: 合計 {case['total_median']:.2f}秒・ピーク {peak}"
+                 f"（画像 {case['report_px'][0]}x{case['report_px'][1]}）")
+    logging.info(f"  {stages}")
+
+def compare(previous, current, tolerance):
+    """前回の結果と中央値を比べ、tolerance（比率）を超えて遅くなった段階の数を返す"""
+    old = {case_key(c): c for c in previous["cases"]}
+    worse = 0
+    logging.info("")
+    logging.info(f"前回（{previous['environment'].get('commit')}）との比較（中央値の比。{1 + tolerance:.2f} 倍を超えたら ▲）")
+    for case in current["cases"]:
+        prev = old.get(case_key(case))
+        if not prev:
+            continue
+        parts = []
+        for s in STAGES + ["peak_rss_mb"]:
+            a = prev["peak_rss_mb"] if s == "peak_rss_mb" else prev["stages"].get(s, {}).get("median")
+            b = case["peak_rss_mb"] if s == "peak_rss_mb" else case["stages"][s]["median"]
+            if not a or b is None:
+                continue
+            ratio = b / a
+            mark = "▲" if ratio > 1 + tolerance else ""
+            worse += bool(mark)
+            parts.append(f"{s} {ratio:.2f}{mark}")
+        logging.info(f"{case_key(case)}: " + "  ".join(parts))
+    return worse
+
+# ==========================================
+# 表の描画の確認
+# ==========================================
+TABLE_CHECK_CASES = [(1, 5), (3, 10), (7, 15), (7, 20), (7, 30)]  # (仕掛けの数, 1つあたりの台数)
+
+def shikake_table_rows(groups, n_rows):
+    """仕掛けレポートと同じ形（見出し・列名・データ・区切り行）の表の行を作る"""
+    import report_core as core
+    rows, h_idx = [], []
+    for g in range(groups):
+        h_idx.append(len(rows))
+        rows.append([f"仕掛け{g + 1}"] * 7)
+        rows.append(list(core.TABLE_HEADER))
+        rows.extend([str(101 + i), "機種名", "1,234G", "3", "2", "0", f"+{i * 100:,}枚"] for i in range(n_rows))
+        rows.append([""] * 7)
+    return rows, h_idx
+
+def check_table_sizes():
+    """Pillow と matplotlib の表の画像の大きさを比べ、食い違った件数を返す"""
+    import report_core as core
+    bad = 0
+    for groups, n_rows in TABLE_CHECK_CASES:
+        rows, h_idx = shikake_table_rows(groups, n_rows)
+        mpl = core.draw_table_matplotlib(rows, h_idx, "#FF6600").size
+        pil = core.draw_table_pillow(rows, h_idx, "#FF6600").size
+        mark = "" if mpl == pil else "  ▲ 食い違い"
+        bad += bool(mark)
+        logging.info(f"{len(rows)}行: matplotlib {mpl[0]}x{mpl[1]} / Pillow {pil[0]}x{pil[1]}{mark}")
+    return bad
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成データでレポート作成の処理時間とメモリを測る")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="台数（カンマ区切り）")
+    parser.add_argument("--encodings", default=",".join(ENCODINGS), help="CSVの文字コード（カンマ区切り）")
+    parser.add_argument("--repeat", type=int, default=3, help="条件ごとの繰り返し回数（中央値を使う）")
+    parser.add_argument("-o", "--out", default="benchmark.json", help="結果の JSON")
+    parser.add_argument("--compare", help="比べる前回の結果の JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="遅くなったとみなす比率（0.2 なら 1.2 倍）")
+    parser.add_argument("--keep-csv", help="合成したCSVを保存するフォルダ")
+    parser.add_argument("--check-tables", action="store_true", help="測らずに、表の画像の大きさが描画方式で同じかだけを確かめる")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.check_tables:
+        return 1 if check_table_sizes() else 0
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    encodings = [e.strip() for e in args.encodings.split(",") if e.strip()]
+    keep_csv = os.path.abspath(args.keep_csv) if args.keep_csv else None
+    if keep_csv:
+        os.makedirs(keep_csv, exist_ok=True)
+    result = {"environment": environment(), "stages": STAGES, "cases": []}
+    # 条件ごとに新しいプロセスで測る（ピークメモリとキャッシュを持ち越さない）
+    ctx = multiprocessing.get_context("spawn")
+    for n in sizes:
+        for enc in encodings:
+            with ctx.Pool(1) as pool:
+                case = pool.apply(run_case, (n, enc, args.repeat, keep_csv))
+            result["cases"].append(case)
+            log_case(case)
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    logging.info(f"結果: {args.out}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        return 1 if compare(previous, result, args.tolerance) else 0
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
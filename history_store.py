@@ -0,0 +1,130 @@
+"""日ごとのデータの履歴（SQLite・WAL モード）
+
+アップロードされたCSVを営業日ごとに1回だけ取り込み、営業日・機種名・台番で引けるようにする。
+週間・月間のレポートは、ここから期間内の合計差枚や「枚数以上だった日数」を集計して作る。
+"""
+import datetime
+import os
+import re
+import sqlite3
+import threading
+
+DB_FILE = "history.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    day TEXT PRIMARY KEY,           -- 営業日（YYYY-MM-DD）
+    csv_digest TEXT NOT NULL UNIQUE,
+    source TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    imported_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS plays (
+    day TEXT NOT NULL,
+    number INTEGER NOT NULL,        -- 台番
+    m_name TEXT NOT NULL,           -- 機種名（CSVのまま）
+    games INTEGER, bb INTEGER, rb INTEGER, art INTEGER, diff INTEGER,
+    PRIMARY KEY (day, number)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS plays_machine_day ON plays (m_name, day);
+CREATE INDEX IF NOT EXISTS plays_number_day ON plays (number, day);
+"""
+
+_local = threading.local()
+
+def _connect():
+    """スレッドごとに接続を1つ持つ"""
+    conn = getattr(_local, "conn", None)
+    # fork した子プロセスでは親の接続を使わない（SQLite の接続はプロセスをまたげない）
+    if conn is None or getattr(_local, "db_file", None) != DB_FILE or getattr(_local, "pid", None) != os.getpid():
+        conn = sqlite3.connect(DB_FILE, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn, _local.db_file, _local.pid = conn, DB_FILE, os.getpid()
+    return conn
+
+# 「20261016」「2026-10-16」「2026_10_16」「2026年10月16日」などをファイル名から拾う
+_DAY_COMPACT = re.compile(r'(20\d{2})(\d{2})(\d{2})')
+_DAY_SEPARATED = re.compile(r'(20\d{2})[-_.年/](\d{1,2})[-_.月/](\d{1,2})')
+
+def day_from_filename(name):
+    """ファイル名に含まれる日付を返す（見つからなければ None）"""
+    for pattern in (_DAY_SEPARATED, _DAY_COMPACT):
+        for m in pattern.finditer(name):
+            try:
+                return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            except ValueError:
+                continue
+    return None
+
+def day_of_digest(csv_digest):
+    """取り込み済みのCSVならその営業日を返す"""
+    row = _connect().execute("SELECT day FROM days WHERE csv_digest = ?", (csv_digest,)).fetchone()
+    return datetime.date.fromisoformat(row[0]) if row else None
+
+def add_day(day, csv_digest, source, records):
+    """1日分を取り込む。records は (台番, 機種名, G数, BB, RB, ART, 差枚) の並び。
+    同じCSV・同じ営業日が取り込み済みなら何もしない。戻り値は "added" / "same_csv" / "day_exists"。"""
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM days WHERE csv_digest = ?", (csv_digest,)).fetchone():
+            result = "same_csv"
+        elif conn.execute("SELECT 1 FROM days WHERE day = ?", (day.isoformat(),)).fetchone():
+            result = "day_exists"
+        else:
+            conn.executemany("INSERT OR IGNORE INTO plays (day, number, m_name, games, bb, rb, art, diff) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", ((day.isoformat(),) + r for r in records))
+            conn.execute("INSERT INTO days (day, csv_digest, source, rows, imported_at) VALUES (?, ?, ?, ?, ?)",
+                         (day.isoformat(), csv_digest, source, len(records),
+                          datetime.datetime.now().isoformat(timespec="seconds")))
+            result = "added"
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return result
+
+def delete_day(day):
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM plays WHERE day = ?", (day.isoformat(),))
+        conn.execute("DELETE FROM days WHERE day = ?", (day.isoformat(),))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def move_day(day, new_day):
+    """取り込み済みの day を new_day に付け替える。new_day に別のCSVが取り込み済みなら何もせず False を返す"""
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        moved = day == new_day or not conn.execute("SELECT 1 FROM days WHERE day = ?", (new_day.isoformat(),)).fetchone()
+        if moved and day != new_day:
+            conn.execute("UPDATE plays SET day = ? WHERE day = ?", (new_day.isoformat(), day.isoformat()))
+            conn.execute("UPDATE days SET day = ? WHERE day = ?", (new_day.isoformat(), day.isoformat()))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return moved
+
+def list_days():
+    """取り込み済みの (営業日, 元のファイル名, 行数) を新しい順に返す"""
+    return [(datetime.date.fromisoformat(d), src, n)
+            for d, src, n in _connect().execute("SELECT day, source, rows FROM days ORDER BY day DESC")]
+
+def aggregate_machine(m_name, start, end, threshold):
+    """機種 m_name の台ごとに、期間 [start, end] の合計と、差枚が threshold 以上だった日数を返す。
+    戻り値は (台番, 日数, G数, BB, RB, ART, 差枚, 枚数以上の日数) の並び（台番順）。"""
+    return _connect().execute(
+        "SELECT number, COUNT(*), SUM(games), SUM(bb), SUM(rb), SUM(art), SUM(diff), COALESCE(SUM(diff >= ?), 0) "
+        "FROM plays WHERE m_name = ? AND day BETWEEN ? AND ? GROUP BY number ORDER BY number",
+        (threshold, m_name, start.isoformat(), end.isoformat())).fetchall()
+
+def count_days(start, end):
+    return _connect().execute("SELECT COUNT(*) FROM days WHERE day BETWEEN ? AND ?",
+                              (start.isoformat(), end.isoformat())).fetchone()[0]
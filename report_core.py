@@ -0,0 +1,1672 @@
+"""レポート画像の描画処理（Streamlit に依存しない部分）
+
+app.py（画面）と batch_render.py（一括出力）の両方から使う。
+"""
+import time
+_import_started = time.perf_counter()
+
+import pandas as pd
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+import io
+import os
+import numpy as np
+import json
+import base64
+import hashlib
+import logging
+import re
+import unicodedata
+import threading
+import struct
+import codecs
+import datetime
+import sys
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pandas.api.types import union_categoricals
+
+import history_store
+import state_store
+
+logger = logging.getLogger(__name__)
+
+# 起動にかかった時間（秒）。画面のキャッシュ状況に表示する
+startup_times = {}
+
+# --- 日本語フォントのセットアップ ---
+# フォントはネットワークから取得しない。環境変数 REPORT_FONT → 作業フォルダ → アプリのフォルダ → OS のフォントの順に探す
+FONT_FILE = "NotoSansCJKjp-Regular.otf"
+FONT_CANDIDATES = [
+    FONT_FILE,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), FONT_FILE),
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+    "C:/Windows/Fonts/meiryo.ttc",
+]
+font_error = None
+
+def get_font_path():
+    global font_error
+    configured = os.environ.get("REPORT_FONT")
+    if configured:
+        if os.path.exists(configured):
+            return configured
+        font_error = f"REPORT_FONT に指定されたフォントがありません: {configured}"
+        logger.error(font_error)
+        return None
+    for path in FONT_CANDIDATES:
+        if os.path.exists(path):
+            return os.path.abspath(path)
+    font_error = (f"日本語フォントが見つかりません。{FONT_FILE} をアプリのフォルダに置くか、"
+                  "環境変数 REPORT_FONT でフォントのパスを指定してください")
+    logger.error(font_error)
+    return None
+
+font_p = get_font_path()
+
+# matplotlib は旧描画（TABLE_RENDERER=matplotlib）でしか使わないので、最初に使うときに読み込む
+_pyplot = None
+_prop = None
+
+def get_pyplot():
+    """(matplotlib.pyplot, 日本語フォントの FontProperties) を返す"""
+    global _pyplot, _prop
+    if _pyplot is None:
+        t0 = time.perf_counter()
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        import matplotlib.font_manager as fm
+        _prop = fm.FontProperties(fname=font_p) if font_p else fm.FontProperties()
+        _pyplot = plt
+        startup_times["matplotlib"] = time.perf_counter() - t0
+    return _pyplot, _prop
+
+# ==========================================
+# キャッシュ（プロセス全体・全セッションで共有）
+# ==========================================
+FONT_CACHE_MAX_ENTRIES = 16
+BANNER_CACHE_MAX_ENTRIES = 64
+
+class LRUCache:
+    """件数上限（とバイト数上限）つきの LRU キャッシュ。ヒット/ミス数を数える"""
+    def __init__(self, maxsize, max_bytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda v: 0)
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        value = factory()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self.sizeof(self._data[key])
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self.nbytes += self.sizeof(value)
+            while len(self._data) > 1 and (len(self._data) > self.maxsize or
+                                           (self.max_bytes and self.nbytes > self.max_bytes)):
+                _, old = self._data.popitem(last=False)
+                self.nbytes -= self.sizeof(old)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data),
+                "maxsize": self.maxsize, "nbytes": self.nbytes, "max_bytes": self.max_bytes}
+
+# このモジュールは一度だけ import されるので、キャッシュはモジュール変数としてプロセス内で共有される
+_font_cache = LRUCache(FONT_CACHE_MAX_ENTRIES)
+_banner_cache = LRUCache(BANNER_CACHE_MAX_ENTRIES)
+
+def get_font_cache():
+    return _font_cache
+
+def get_banner_cache():
+    return _banner_cache
+
+def _truetype(path, size):
+    try:
+        return ImageFont.truetype(path, size)
+    except:
+        return ImageFont.load_default()
+
+def load_font(size, text=None):
+    """読み込み済みの FreeTypeFont を (フォントパス, サイズ) ごとに使い回す。
+    text を渡すと、その文字がすべてサブセットにあればサブセットのフォントを返す（無い文字があれば元のフォント）"""
+    path = font_p
+    if text is not None:
+        subset = get_subset_font()
+        if subset and subset["chars"].issuperset(text):
+            path = subset["path"]
+    return get_font_cache().get_or_create((path, size), lambda: _truetype(path, size))
+
+# --- サブセットフォント ---
+# CJK フォントは数万字あり、サイズごとに読み込むと重い。表や看板に使う文字だけを抜き出したフォントを作って
+# .cache/fonts に置き、次回からはそれを使う（元のフォントと抜き出す文字が同じなら作り直さない）。
+# fontTools が無ければ作らずに元のフォントを使う
+FONT_SUBSET_DIR = os.path.join(".cache", "fonts")
+FONT_SUBSET_RANGES = [(0x20, 0x7E), (0x3000, 0x30FF), (0xFF01, 0xFF9F)]  # 英数字・記号、かな・約物、全角英数・半角カナ
+FONT_SUBSET_LABELS = "優秀台枚ゲーム数差上位全系末尾"
+
+def _jis_level1_kanji():
+    """JIS 第1水準の漢字（機種名に使われる漢字のほとんどはここに入る）"""
+    chars = set()
+    for lead in range(0x88, 0x99):
+        for trail in range(0x40, 0xFD):
+            try:
+                chars.add(bytes([lead, trail]).decode("cp932"))
+            except UnicodeDecodeError:
+                pass
+    return chars
+
+_subset_lock = threading.Lock()
+_subset_font = None
+
+def _subset_charset():
+    """サブセットに入れる文字：基本の範囲・第1水準の漢字と、表の見出し・看板の既定の文字・置換辞書・保存済みの設定に出てくる文字"""
+    chars = {chr(c) for lo, hi in FONT_SUBSET_RANGES for c in range(lo, hi + 1)} | _jis_level1_kanji()
+    texts = [FONT_SUBSET_LABELS, "".join(TABLE_HEADER)] + [cfg["def_txt"] for cfg in FILES.values()]
+    texts.extend(str(v) for kv in get_rename_dict().items() for v in kv)
+    try:
+        state = _state()
+        texts.extend(state["banners"].values())
+        texts.extend(str(dn) for targets in state["targets"].values() for _, dn, _ in targets)
+        texts.extend(state["shikake"])
+    except:
+        pass
+    for t in texts:
+        chars.update(t)
+    return chars
+
+def _build_subset_font(path, chars, out_path):
+    from fontTools import subset
+    logging.getLogger("fontTools").setLevel(logging.WARNING)  # 字ごとの経過が INFO で大量に出る
+    options = subset.Options()
+    options.font_number = 0          # .ttc は先頭のフォントを使う（ImageFont.truetype の既定と同じ）
+    options.layout_features = ["*"]
+    options.name_IDs = ["*"]
+    options.notdef_outline = True
+    font = subset.load_font(path, options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=[ord(c) for c in chars])
+    subsetter.subset(font)
+    os.makedirs(FONT_SUBSET_DIR, exist_ok=True)
+    tmp = f"{out_path}.{os.getpid()}.tmp"
+    subset.save_font(font, tmp, options)
+    os.replace(tmp, out_path)
+
+def get_subset_font():
+    """{"path": サブセットのパス, "chars": 含む文字} を返す（作れなければ None）。最初の呼び出しで作るか読み込む"""
+    global _subset_font
+    if _subset_font is not None or not font_p:
+        return _subset_font or None
+    with _subset_lock:
+        if _subset_font is None:
+            t0 = time.perf_counter()
+            _subset_font = {}
+            try:
+                chars = _subset_charset()
+                st = os.stat(font_p)
+                key = hashlib.sha1(f"{os.path.abspath(font_p)}|{st.st_size}|{st.st_mtime_ns}|".encode()
+                                   + "".join(sorted(chars)).encode("utf-8")).hexdigest()[:16]
+                ext = ".otf" if font_p.lower().endswith((".otf", ".otc")) else ".ttf"
+                out_path = os.path.join(FONT_SUBSET_DIR, f"subset_{key}{ext}")
+                if not os.path.exists(out_path):
+                    _build_subset_font(font_p, chars, out_path)
+                    logger.info(f"サブセットフォントを作成しました: {out_path}（{len(chars)}字・"
+                                f"{os.path.getsize(out_path) / 1024:.0f}KB）")
+                _subset_font = {"path": out_path, "chars": frozenset(chars)}
+            except ImportError:
+                logger.info("fontTools が無いためサブセットフォントは使いません")
+            except Exception as e:
+                logger.warning(f"サブセットフォントを作れませんでした: {e}")
+            startup_times["font_subset"] = time.perf_counter() - t0
+    return _subset_font or None
+
+# ==========================================
+# 処理の計測（段階ごとの時間・メモリの増減・入力の大きさ）
+# ==========================================
+# with profile_stage("encode", fmt="PNG") as p: ... p.info["bytes"] = n のように囲むと、
+# 経過時間・常駐メモリの増減・ピークの増加を1件の記録にして、プロセス内の直近の記録と
+# JSON Lines のログ（ワーカープロセスの分も同じファイルに追記される）に残す
+PROFILE_LOG = os.environ.get("REPORT_PROFILE_LOG", os.path.join(".cache", "profile.jsonl"))
+PROFILE_LOG_MAX_BYTES = 20 * 1024 * 1024   # 超えたら .1 に回して新しく書き始める
+PROFILE_RECENT = 500
+
+_profile_recent = deque(maxlen=PROFILE_RECENT)
+_profile_local = threading.local()
+_profile_lock = threading.Lock()
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def _rss_bytes():
+    """現在の常駐メモリ（/proc が無い環境では None）"""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except:
+        return None
+
+def _peak_rss_bytes():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except:
+        return None
+
+def set_profile_session(session_id):
+    """このスレッドで記録するものにセッションの ID を付ける（画面側から呼ぶ）"""
+    _profile_local.session = session_id
+
+class profile_stage:
+    def __init__(self, stage, **info):
+        self.stage = stage
+        self.info = info
+
+    def __enter__(self):
+        stack = _profile_local.__dict__.setdefault("stack", [])
+        self.parent = stack[-1] if stack else None
+        stack.append(self.stage)
+        self.rss0, self.peak0 = _rss_bytes(), _peak_rss_bytes()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.t0
+        _profile_local.stack.pop()
+        rss1, peak1 = _rss_bytes(), _peak_rss_bytes()
+        record = {
+            "ts": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "stage": self.stage, "parent": self.parent, "seconds": round(seconds, 6),
+            "rss_delta_mb": round((rss1 - self.rss0) / 1048576, 2) if rss1 is not None and self.rss0 is not None else None,
+            "peak_delta_mb": round((peak1 - self.peak0) / 1048576, 2) if peak1 is not None and self.peak0 is not None else None,
+            "pid": os.getpid(), "session": getattr(_profile_local, "session", None),
+        }
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        record.update(self.info)
+        _profile_recent.append(record)
+        _append_profile_log(record)
+        return False
+
+def _append_profile_log(record):
+    if not PROFILE_LOG:
+        return
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    try:
+        with _profile_lock:
+            os.makedirs(os.path.dirname(PROFILE_LOG) or ".", exist_ok=True)
+            if os.path.exists(PROFILE_LOG) and os.path.getsize(PROFILE_LOG) > PROFILE_LOG_MAX_BYTES:
+                os.replace(PROFILE_LOG, PROFILE_LOG + ".1")
+            # 1行ずつ追記モードで書くので、複数のプロセスから書いても行が混ざらない
+            with open(PROFILE_LOG, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError:
+        pass
+
+def recent_profile_records():
+    """このプロセスの直近の記録（新しい順）"""
+    return list(reversed(_profile_recent))
+
+def read_profile_log(limit=5000, path=None):
+    """ログの末尾から最大 limit 件を読む（全プロセス・全セッションの分）"""
+    path = path or PROFILE_LOG
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - limit * 400))
+            lines = f.read().splitlines()[-limit:]
+    except OSError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass  # 途中から読んだ最初の行など
+    return records
+
+def summarize_profile(records):
+    """段階ごとに 回数・合計/平均/最大の秒数・メモリの増減の平均と最大 をまとめた表を返す"""
+    if not records:
+        return pd.DataFrame()
+    df = pd.DataFrame(records)
+    for col in ("rss_delta_mb", "peak_delta_mb"):
+        if col not in df.columns:
+            df[col] = np.nan
+    summary = df.groupby("stage").agg(
+        count=("seconds", "size"), total_s=("seconds", "sum"), mean_s=("seconds", "mean"), max_s=("seconds", "max"),
+        rss_delta_mb=("rss_delta_mb", "mean"), peak_delta_mb=("peak_delta_mb", "max"))
+    return summary.sort_values("total_s", ascending=False)
+
+# ==========================================
+# 機種名置換辞書
+# ==========================================
+RENAME_FILE = "rename_list.csv"
+
+# 表記ゆれの吸収：全角/半角（NFKC）・大文字小文字・空白と、末尾のバージョン表記（Ver.2 など）・
+# 括弧の注記（(新台) など）・記号（★ など）を無視したキーでも引けるようにする。
+# 末尾の数字や V・II などは別の機種を表すことが多いので残す
+# 飾りは逆順にした文字列の先頭から1つずつ外す（繰り返しを1つの正規表現に入れて末尾に $ で合わせると、
+# 空白の多い名前で指数的にバックトラックする）。パターンは「ver 1.2」「(新台)」「★」などを逆から読んだもの
+_RENAME_TRAILING_REV = re.compile(r'[\s★☆※◆◇●○■□*]+|[\)\]】][^\(\[【\)\]】]*[\(\[【]|(?:\d+\.)*\d+\s*\.?rev')
+_RENAME_SPACES = re.compile(r'\s+')
+
+def _strip_trailing_marks(key):
+    rev, pos = key[::-1], 0
+    while True:
+        m = _RENAME_TRAILING_REV.match(rev, pos)
+        if m is None:
+            return key[:len(key) - pos]
+        pos = m.end()
+
+def normalize_machine_key(name):
+    key = unicodedata.normalize('NFKC', str(name)).lower().replace('〜', '~')
+    return _RENAME_SPACES.sub('', _strip_trailing_marks(key)) or key
+
+_rename_lock = threading.Lock()
+_rename_table = {"stamp": None, "version": 0, "dict": {}, "index": {}, "display_index": {}, "error": None}
+
+def _load_rename_table(stamp, version):
+    """置換ファイルを読み、元の名前 → 表示名の辞書と、正規化したキーの索引を作る"""
+    table = {"stamp": stamp, "version": version, "dict": {}, "index": {}, "display_index": {}, "error": None}
+    if stamp is None:
+        return table
+    with profile_stage("rename_dict", file=RENAME_FILE) as p:
+        try:
+            try:
+                rename_df = pd.read_csv(RENAME_FILE, encoding='utf-8-sig')
+            except:
+                rename_df = pd.read_csv(RENAME_FILE, encoding='cp932')
+            table["dict"] = {str(o): str(d) for o, d in zip(rename_df['original_name'], rename_df['display_name'])
+                             if pd.notna(o) and pd.notna(d)}
+        except Exception as e:
+            table["error"] = f"置換ファイルの読み取りエラー: {e}"
+            logger.warning(table["error"])
+        index, ambiguous = {}, set()
+        for o, d in table["dict"].items():
+            key = normalize_machine_key(o)
+            if index.get(key, d) != d:
+                ambiguous.add(key)  # 正規化すると同じになる別々の名前は、どちらにも寄せない
+            index[key] = d
+            table["display_index"].setdefault(normalize_machine_key(d), []).append(o)
+        table["index"] = {k: d for k, d in index.items() if k not in ambiguous}
+        p.info["entries"] = len(table["dict"])
+    return table
+
+def get_rename_table():
+    """置換辞書（共有オブジェクトなので書き換えないこと）。ファイルの更新日時かサイズが変わっていれば読み直し、
+    version を1つ進める"""
+    global _rename_table
+    try:
+        st = os.stat(RENAME_FILE)
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+    if _rename_table["version"] and stamp == _rename_table["stamp"]:
+        return _rename_table
+    with _rename_lock:
+        if not _rename_table["version"] or stamp != _rename_table["stamp"]:
+            _rename_table = _load_rename_table(stamp, _rename_table["version"] + 1)
+        return _rename_table
+
+def get_rename_dict():
+    return get_rename_table()["dict"]
+
+def lookup_rename(table, name):
+    """表示名を返す。辞書に無ければ正規化したキーで引き、それも無ければ元の名前のまま"""
+    d = table["dict"].get(name)
+    if d is None:
+        d = table["index"].get(normalize_machine_key(name))
+    return d if d is not None else name
+
+def apply_rename(name):
+    if name == "-- 選択 --" or not name: return ""
+    return lookup_rename(get_rename_table(), name)
+
+# ==========================================
+# 設定の保存（state_store の SQLite。旧形式のファイルは初回起動時に取り込む）
+# ==========================================
+_state_ready = False
+
+def _state():
+    global _state_ready
+    if not _state_ready:
+        if not state_store.imported():
+            state_store.import_state(_read_legacy_files())
+            logger.info("旧形式の設定ファイルを %s に取り込みました", state_store.DB_FILE)
+        _state_ready = True
+    return state_store.snapshot()
+
+def load_banner_text(sid):
+    text = (_state()["banners"].get(sid) or "").strip()
+    return text if text else FILES[sid]["def_txt"]
+
+def save_banner_text(sid, text):
+    state_store.set_banner(sid, text)
+
+def load_targets(sid):
+    return list(_state()["targets"].get(sid, []))
+
+def save_targets(sid, targets):
+    state_store.set_targets(sid, targets)
+
+def load_shikake_content():
+    return list(_state()["shikake"])
+
+def save_shikake_content(content_list):
+    state_store.set_shikake(content_list)
+
+def save_shikake_slot(j, content):
+    state_store.set_shikake_slot(j, content)
+
+def load_images(sid):
+    return dict(_state()["images"].get(sid, {}))
+
+def save_images(sid, manifest):
+    # 正規化済みの画像に置き換わったものは新しいハッシュで保存する（古いハッシュを書き戻さない）
+    state_store.set_images(sid, {dn: resolve_image_digest(d) for dn, d in manifest.items()})
+
+def load_form_state(sid):
+    return json.loads(json.dumps(_state()["form_state"].get(sid, {})))
+
+def save_form_state(sid, data):
+    state_store.set_form_state(sid, data)
+
+# --- 旧形式のファイル（取り込み用）---
+SHIKAKE_FILE = "shikake_content3.json"
+
+def _read_legacy_text(filename):
+    if os.path.exists(filename):
+        with open(filename, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    return ""
+
+def _read_legacy_targets(filename):
+    if os.path.exists(filename):
+        try:
+            df_load = pd.read_csv(filename)
+            return [tuple(x) for x in df_load.to_numpy()]
+        except:
+            return []
+    return []
+
+def _read_legacy_json(filename, default):
+    if os.path.exists(filename):
+        try:
+            with open(filename, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except:
+            pass
+    return default
+
+def _read_legacy_images(filename, legacy_filename=None):
+    if os.path.exists(filename):
+        data = _read_legacy_json(filename, {})
+        return {dn: h for dn, h in data.items() if isinstance(h, str)} if isinstance(data, dict) else {}
+    # さらに古い形式（base64 を埋め込んだ JSON）はストアへ移す。旧ファイルはそのまま残す
+    if legacy_filename and os.path.exists(legacy_filename):
+        try:
+            with open(legacy_filename, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return {dn: put_image_blob(base64.b64decode(b)) for dn, b in data.items()}
+        except:
+            pass
+    return {}
+
+def _read_legacy_files():
+    state = {"banners": {}, "targets": {}, "images": {}, "form_state": {}, "shikake": [""] * 7}
+    for sid, cfg in FILES.items():
+        text = _read_legacy_text(cfg["txt"])
+        if text:
+            state["banners"][sid] = text
+        if cfg["csv"]:
+            state["targets"][sid] = _read_legacy_targets(cfg["csv"])
+        if cfg.get("img"):
+            state["images"][sid] = _read_legacy_images(cfg["img"], cfg.get("img_legacy"))
+        fs = _read_legacy_json(f"form_state{sid}.json", {})
+        if fs:
+            state["form_state"][sid] = fs
+    shikake = _read_legacy_json(SHIKAKE_FILE, None)
+    if isinstance(shikake, list) and len(shikake) == 7:
+        state["shikake"] = shikake
+    return state
+
+# --- 機種画像：内容のハッシュで1枚ずつ保存し、表示名→ハッシュの対応表だけを JSON に持つ ---
+IMAGE_STORE_DIR = "image_store"
+
+def image_blob_path(digest):
+    return os.path.join(IMAGE_STORE_DIR, digest[:2], digest)
+
+def put_image_blob(data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = image_blob_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return digest
+
+# --- 縮小済み機種画像のキャッシュ：新しいものはメモリ、古いものはディスクに置く ---
+RESIZED_CACHE_DIR = os.path.join(".cache", "resized")
+RESIZED_MEMORY_MAX_BYTES = 256 * 1024 * 1024
+RESIZED_DISK_MAX_BYTES = 1024 * 1024 * 1024
+
+def _image_nbytes(img):
+    return img.width * img.height * len(img.getbands()) if img is not None else 0
+
+_resized_cache = LRUCache(256, max_bytes=RESIZED_MEMORY_MAX_BYTES, sizeof=_image_nbytes)
+
+def get_resized_cache():
+    return _resized_cache
+
+def _touch(path):
+    """ファイルの更新日時を今にする（LRU の順番を進める）。他のプロセスに消されていたら False"""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+def _evict_disk_lru(directory, max_bytes):
+    """フォルダの合計サイズが max_bytes を超えたら、更新日時の古いファイルから消す。
+    他のプロセスも同時に消していることがあるので、途中で消えたファイルは飛ばす"""
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(".tmp"):  # 書き込み途中
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st_ = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st_.st_mtime, st_.st_size, path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def _load_or_resize(digest, width, mode):
+    path = os.path.join(RESIZED_CACHE_DIR, f"{digest}_{width}_{mode}.raw")
+    try:
+        with open(path, "rb") as f:
+            w, h = struct.unpack("<II", f.read(8))
+            img = Image.frombytes(mode, (w, h), f.read())
+        _touch(path)
+        return img
+    except OSError:
+        pass  # 無い（他のプロセスが消した場合も）ので作り直す
+    raw = open_image_blob(digest)
+    if raw is None:
+        return None
+    with profile_stage("photo_resize", px=[raw.width, raw.height], width=width):
+        raw = raw.convert(mode)
+        img = raw.resize((width, int(raw.height * width / raw.width)), Image.LANCZOS)
+    os.makedirs(RESIZED_CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<II", img.width, img.height))
+        f.write(img.tobytes())
+    os.replace(tmp, path)
+    _evict_disk_lru(RESIZED_CACHE_DIR, RESIZED_DISK_MAX_BYTES)
+    return img
+
+def get_resized_image(digest, width, mode="RGBA"):
+    """機種画像を幅 width に縮小したものを (画像ハッシュ, 幅, モード) ごとに使い回す（共有オブジェクト）"""
+    if not digest:
+        return None
+    digest = resolve_image_digest(digest)
+    return get_resized_cache().get_or_create((digest, width, mode), lambda: _load_or_resize(digest, width, mode))
+
+def open_image_blob(digest):
+    """レポートで必要になった時点でファイルから開く（無ければ None）"""
+    digest = resolve_image_digest(digest)
+    if not digest or not os.path.exists(image_blob_path(digest)):
+        return None
+    return Image.open(image_blob_path(digest))
+
+# --- アップロードされた機種画像の正規化 ---
+# 向きを直し（EXIF の回転情報）、メタデータを落とし、レポートの横幅まで縮小して WebP で保存し直す。
+# 元の画像は消し、同じ場所に「.moved」（新しいハッシュ）を残す。古いハッシュを持ったままのセッションや
+# 描画プロセスからも resolve_image_digest で新しい画像を引ける。
+PHOTO_FORMAT = "WEBP"
+PHOTO_QUALITY = 85
+_photo_executor = None
+_photo_pending = set()
+_photo_lock = threading.Lock()
+
+def photo_max_width():
+    """機種画像を貼る最大の幅（レポートの表の横幅）"""
+    return TABLE_WIDTH_INCH * TABLE_DPI
+
+def resolve_image_digest(digest):
+    """正規化で置き換えられた画像なら、置き換え先のハッシュを返す"""
+    if not digest or os.path.exists(image_blob_path(digest)):
+        return digest
+    try:
+        with open(image_blob_path(digest) + ".moved", "r", encoding="ascii") as f:
+            return f.read().strip() or digest
+    except OSError:
+        return digest
+
+def _is_normalized_photo(img, max_width):
+    return (img.format == PHOTO_FORMAT and img.width <= max_width
+            and not img.info.get("exif") and not img.info.get("icc_profile"))
+
+def normalize_photo(data, max_width=None):
+    """画像ファイルの中身を正規化した WebP の中身にする（正規化済みなら None）"""
+    max_width = max_width or photo_max_width()
+    img = Image.open(io.BytesIO(data))
+    if _is_normalized_photo(img, max_width):
+        return None
+    # JPEG は縮小しながら読み込める（縦横どちらが横幅になっても足りる大きさまで）
+    img.draft("RGB", (max_width, max_width))
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    img = img.convert("RGBA" if has_alpha else "RGB")
+    if img.width > max_width:
+        img = img.resize((max_width, max(1, round(img.height * max_width / img.width))), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, PHOTO_FORMAT, quality=PHOTO_QUALITY, method=4)
+    return buf.getvalue()
+
+def _normalize_stored_photo(digest):
+    """ストアの画像1枚を正規化して置き換える（バックグラウンドのスレッドで実行）。新しいハッシュを返す"""
+    try:
+        path = image_blob_path(digest)
+        if not os.path.exists(path):
+            return resolve_image_digest(digest)
+        with open(path, "rb") as f:
+            data = f.read()
+        with profile_stage("photo_normalize", kb_in=len(data) // 1024) as p:
+            out = normalize_photo(data)
+            if out is None:
+                return digest
+            p.info["kb_out"] = len(out) // 1024
+            new = put_image_blob(out)
+        if new == digest:
+            return digest
+        tmp = f"{path}.moved.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="ascii") as f:
+            f.write(new)
+        os.replace(tmp, path + ".moved")
+        state_store.replace_image_digest(digest, new)
+        os.remove(path)
+        logger.info("機種画像を正規化しました: %s → %s（%dKB → %dKB）", digest[:12], new[:12], len(data) // 1024, len(out) // 1024)
+        return new
+    except Exception as e:
+        logger.warning(f"機種画像を正規化できませんでした（{digest[:12]}）: {e}")
+        return digest
+    finally:
+        with _photo_lock:
+            _photo_pending.discard(digest)
+
+def submit_photo_normalization(digests):
+    """画像の正規化をバックグラウンドのスレッドに任せる（すぐに戻る）。処理中のものは重ねて投げない"""
+    global _photo_executor
+    with _photo_lock:
+        if _photo_executor is None:
+            _photo_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="photo-normalize")
+        for digest in digests:
+            if digest and digest not in _photo_pending:
+                _photo_pending.add(digest)
+                _photo_executor.submit(_normalize_stored_photo, digest)
+
+def put_uploaded_photo(data):
+    """アップロードされた画像をそのまま保存してハッシュを返し、正規化はバックグラウンドで行う"""
+    digest = put_image_blob(data)
+    submit_photo_normalization([digest])
+    return digest
+
+def normalize_stored_photos():
+    """対応表に載っている画像のうち、まだ正規化していないものをバックグラウンドで正規化する"""
+    _state()
+    submit_photo_normalization(state_store.image_digests())
+
+# ==========================================
+# レポートの設定
+# ==========================================
+# csv / txt / img / img_legacy は旧形式のファイル名（初回起動時の取り込みにだけ使う）
+FILES = {
+    "1": {"csv": "targets1_data.csv", "txt": "banner_text1.txt", "def_txt": "週間おススメ機種", "color": "#FF0000", "img": "images1_manifest.json", "img_legacy": "images1.json"},
+    "2": {"csv": "targets2_data.csv", "txt": "banner_text2.txt", "def_txt": "月間おススメ機種", "color": "#007BFF", "img": "images2_manifest.json", "img_legacy": "images2.json"},
+    "3": {"csv": "targets3_data.csv", "txt": "banner_text3.txt", "def_txt": "仕掛けレポート",  "color": "#FF6600", "img": "images3_manifest.json", "img_legacy": "images3.json"},
+    "4": {"csv": "targets4_data.csv", "txt": "banner_text4.txt", "def_txt": "1月の新台",       "color": "#DC5DE0", "img": "images4_manifest.json", "img_legacy": "images4.json"},
+    "5": {"csv": None,                "txt": "banner_text5.txt", "def_txt": "差玉TOP10",       "color": "#000000", "img": None}
+}
+
+# ==========================================
+# CSV読み込み
+# ==========================================
+CSV_SAMPLE_BYTES = 64 * 1024               # 文字コードの判定に使う先頭部分
+CSV_CHUNK_THRESHOLD = 32 * 1024 * 1024     # これより大きいCSVは分割して読む
+CSV_CHUNK_ROWS = 100_000
+CSV_OPTIONAL_COLUMNS = ['G数', 'BB', 'RB', 'ART']  # 表に出す列（無いCSVもある）
+
+def detect_encoding(data):
+    """先頭部分だけを見て文字コードを決める（UTF-8 として読めなければ cp932）"""
+    if data.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    sample = data[:CSV_SAMPLE_BYTES]
+    try:
+        # 途中で切れた文字は final=False なら続きを待つだけでエラーにならない
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=len(data) <= CSV_SAMPLE_BYTES)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp932'
+
+def _compact_int(s):
+    """数値の列を、値の範囲に収まる最も小さい整数型にする（欠損があれば pandas の Int 型）。
+    小数を含む列はそのまま返す。"""
+    v = pd.to_numeric(s, errors='coerce')
+    valid = v.dropna()
+    if not (valid == np.floor(valid)).all():
+        return v
+    if len(valid) == len(v):
+        return pd.to_numeric(v, downcast='integer')
+    lo, hi = (valid.min(), valid.max()) if len(valid) else (0, 0)
+    for t in ('int8', 'int16', 'int32', 'int64'):
+        if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+            return v.astype(t.capitalize())
+
+def _compact_frame(df, col_m_name):
+    for col in df.columns:
+        if col != col_m_name:
+            df[col] = _compact_int(df[col])
+    return df
+
+def _read_csv_compact(data, encoding, usecols, col_m_name):
+    kw = {"encoding": encoding, "usecols": usecols, "dtype": {col_m_name: 'category'}}
+    if len(data) <= CSV_CHUNK_THRESHOLD:
+        return _compact_frame(pd.read_csv(io.BytesIO(data), **kw), col_m_name)
+    # 大きいCSVは分割して読み、分割ごとに型を詰めてから連結する（文字列の列を丸ごと持たない）
+    parts = [_compact_frame(chunk, col_m_name)
+             for chunk in pd.read_csv(io.BytesIO(data), chunksize=CSV_CHUNK_ROWS, **kw)]
+    names = union_categoricals([p[col_m_name] for p in parts])
+    df = pd.concat([p.drop(columns=col_m_name) for p in parts], ignore_index=True)
+    df[col_m_name] = names
+    # 分割ごとに型が違うと連結で広い型になるので、もう一度詰める
+    return _compact_frame(df, col_m_name)[usecols]
+
+def parse_csv_bytes(data):
+    """CSVを読み込む。使う列だけを読み、機種名はカテゴリ型、数値は小さい整数型にする"""
+    t0 = time.perf_counter()
+    encoding = detect_encoding(data)
+    try:
+        header = pd.read_csv(io.BytesIO(data), encoding=encoding, nrows=0).columns
+    except UnicodeDecodeError:
+        encoding = 'cp932'
+        header = pd.read_csv(io.BytesIO(data), encoding=encoding, nrows=0).columns
+    cols = {
+        "m_name": next((c for c in header if '機種名' in c), None),
+        "number": next((c for c in header if '台番' in c), None),
+        "diff": next((c for c in header if '差枚' in c), None),
+    }
+    missing = [k for k, label in [("m_name", "機種名"), ("number", "台番"), ("diff", "差枚")] if cols[k] is None]
+    if missing:
+        raise ValueError(f"CSVに必要な列がありません: {'・'.join({'m_name': '機種名', 'number': '台番', 'diff': '差枚'}[k] for k in missing)}")
+    wanted = set(cols.values()) | set(CSV_OPTIONAL_COLUMNS)
+    usecols = [c for c in header if c in wanted]
+    try:
+        df = _read_csv_compact(data, encoding, usecols, cols["m_name"])
+    except UnicodeDecodeError:
+        # 先頭は UTF-8 として読めても途中で読めない場合だけ、cp932 で読み直す
+        encoding = 'cp932'
+        df = _read_csv_compact(data, encoding, usecols, cols["m_name"])
+    machine_list = sorted(df[cols["m_name"]].dropna().unique().tolist())
+    footprint = {
+        "encoding": encoding, "rows": len(df), "columns": len(df.columns),
+        "file_bytes": len(data), "memory_bytes": int(df.memory_usage(deep=True).sum()),
+        "seconds": time.perf_counter() - t0,
+    }
+    logger.info("CSV読み込み: %d行・%d列（%s）ファイル %.1fMB → メモリ %.1fMB・%.2f秒",
+                footprint["rows"], footprint["columns"], encoding, len(data) / 1024 / 1024,
+                footprint["memory_bytes"] / 1024 / 1024, footprint["seconds"])
+    return {"df": df, "cols": cols, "machine_list": machine_list, "footprint": footprint}
+
+def build_machine_index(df, col_m_name, col_number, col_diff):
+    """機種名ごとに 差枚→台番 の昇順で並べた部分表と、その差枚の配列を作る（CSVごとに1回）"""
+    ordered = df[df[col_diff].notna()].sort_values([col_diff, col_number], kind='mergesort')
+    # 列は小さい整数型で持つが、二分探索に使う差枚の配列は int64 にそろえる
+    return {name: (g[col_diff].to_numpy(dtype='int64'), g)
+            for name, g in ordered.groupby(col_m_name, sort=False, observed=True)}
+
+def select_targets(machine_index, targets, col_number):
+    """登録済みの (機種名, 表示名, 枚数) をまとめて引き、差枚が枚数以上の台を台番順で返す。
+    表全体は走査せず、機種ごとの差枚配列を二分探索して末尾側を切り出すだけ。"""
+    sections = []
+    for cn, dn, thr in targets:
+        entry = machine_index.get(cn)
+        if entry is None:
+            continue
+        diffs, g = entry
+        hit = g.iloc[np.searchsorted(diffs, thr, side='left'):]
+        if not hit.empty:
+            sections.append((dn, hit.sort_values(col_number)))
+    return sections
+
+def threshold_preview(machine_index, m_name, threshold, step=500):
+    """機種 m_name で差枚が threshold 以上の台数と、差枚の分布を返す（表も画像も作らない）。
+    機種ごとの差枚の昇順配列を二分探索するだけなので、枚数を変えるたびに呼んでよい。
+    around は threshold の前後 step 刻みでの (枚数, 台数)。"""
+    entry = machine_index.get(m_name)
+    if entry is None:
+        return None
+    diffs = entry[0]
+    n = len(diffs)
+    def count_at(thr):
+        return n - int(np.searchsorted(diffs, thr, side='left'))
+    hits = count_at(threshold)
+    hit = diffs[n - hits:]
+    return {
+        "total": n, "hits": hits,
+        "min": int(diffs[0]), "median": int(diffs[(n - 1) // 2]), "max": int(diffs[-1]),
+        "hit_min": int(hit[0]) if hits else None, "hit_median": int(hit[(hits - 1) // 2]) if hits else None,
+        "around": [(threshold + k * step, count_at(threshold + k * step)) for k in (-2, -1, 0, 1, 2)],
+    }
+
+# ==========================================
+# 台番インデックスと台番指定（仕掛けレポート用）
+# ==========================================
+# 「・」は機種名の中にも使われるので区切りにしない
+SELECTOR_SPLIT = re.compile(r'[,、，\n]+')
+SELECTOR_RANGE = re.compile(r'^(\d+)[-~〜ー−](\d+)$')
+SELECTOR_SUFFIX = re.compile(r'^末尾(\d+)$')
+
+def build_number_index(df, col_number, col_m_name):
+    """台番・機種名 → 行位置 の対応表を作る（CSVごとに1回）"""
+    nums = pd.to_numeric(df[col_number], errors='coerce')
+    valid = nums.notna().to_numpy()
+    pos = np.flatnonzero(valid)
+    key = nums[valid].astype('int64')
+    by_number = {int(k): pos[v] for k, v in key.groupby(key.to_numpy()).indices.items()}
+    by_name = dict(df.groupby(col_m_name, observed=True).indices)
+    by_key = {}
+    for name in by_name:
+        by_key.setdefault(normalize_machine_key(name), []).append(name)
+    return {
+        "by_number": by_number,
+        "numbers": np.array(sorted(by_number), dtype='int64'),
+        "by_name": by_name,
+        "by_key": by_key,  # 正規化した機種名 → CSV上の名前
+    }
+
+def _resolve_token(number_index, token):
+    """指定1つを行位置のリストに変換する（CSVに無い台番・機種名なら None）"""
+    numbers = number_index["numbers"]
+    norm = unicodedata.normalize('NFKC', token).replace(' ', '')
+    m_range, m_suffix = SELECTOR_RANGE.match(norm), SELECTOR_SUFFIX.match(norm)
+    if norm.isdigit():
+        hits = number_index["by_number"].get(int(norm))
+        return list(hits) if hits is not None else None
+    if m_range:
+        lo, hi = sorted((int(m_range.group(1)), int(m_range.group(2))))
+        hits = numbers[np.searchsorted(numbers, lo, side='left'):np.searchsorted(numbers, hi, side='right')]
+    elif m_suffix:
+        digits = m_suffix.group(1)
+        hits = numbers[numbers % (10 ** len(digits)) == int(digits)]
+    else:
+        # 機種名はCSV上の名前・置換後の表示名のどちらでも指定できる（表記ゆれは正規化したキーで引く）
+        if token in number_index["by_name"]:
+            names = [token]
+        else:
+            key = normalize_machine_key(token)
+            names = set(number_index["by_key"].get(key, ()))
+            for o in get_rename_table()["display_index"].get(key, ()):
+                names.update(number_index["by_key"].get(normalize_machine_key(o), ()))
+            names = sorted(names)
+        if not names:
+            return None
+        return [p for name in names for p in number_index["by_name"][name]]
+    return [p for n in hits for p in number_index["by_number"].get(int(n), ())]
+
+def resolve_selector(number_index, expr):
+    """「101-140」「末尾7」「機種名」をカンマ区切りで並べた指定を行位置に変換する。
+    空白で区切ったものは、まとめて1つの機種名として引けなければ1つずつの指定として読む。
+    戻り値は (行位置のリスト, 解釈できなかった指定（CSVに無い台番・機種名を含む）のリスト)。"""
+    positions, unresolved = [], []
+    for chunk in SELECTOR_SPLIT.split(expr or ""):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        hits = _resolve_token(number_index, chunk)
+        if hits is None and len(chunk.split()) > 1:
+            tokens = [(t, _resolve_token(number_index, t)) for t in chunk.split()]
+        else:
+            tokens = [(chunk, hits)]
+        for token, hits in tokens:
+            if hits is None:
+                unresolved.append(token)
+            else:
+                positions.extend(hits)
+    return positions, unresolved
+
+def resolve_shikake(number_index, specs):
+    """7つの仕掛けの (台番リスト, 指定式) をまとめて行位置（重複なし）に変換する"""
+    resolved = []
+    for numbers, expr in specs:
+        positions, unresolved = resolve_selector(number_index, expr)
+        for n in numbers:
+            positions.extend(number_index["by_number"].get(int(n), ()))
+        resolved.append((np.unique(np.asarray(positions, dtype='int64')), unresolved))
+    return resolved
+
+def build_csv_bundle(data):
+    """CSVを読み込み、表・列名・機種一覧と各種インデックスをまとめて返す"""
+    with profile_stage("csv_load", bytes=len(data)) as p:
+        with profile_stage("csv_parse", bytes=len(data)):
+            bundle = parse_csv_bytes(data)
+        cols = bundle["cols"]
+        display_names(bundle)
+        with profile_stage("csv_index", rows=len(bundle["df"])):
+            bundle["machine_index"] = build_machine_index(bundle["df"], cols["m_name"], cols["number"], cols["diff"])
+            bundle["number_index"] = build_number_index(bundle["df"], cols["number"], cols["m_name"])
+        p.info["rows"] = len(bundle["df"])
+    return bundle
+
+# ワーカープロセス内で同じCSVを何度も読み込まないように保持する
+_bundle_cache = LRUCache(4)
+
+def get_csv_bundle(data, digest=None):
+    digest = digest or hashlib.sha1(data).hexdigest()
+    return _bundle_cache.get_or_create(digest, lambda: build_csv_bundle(data))
+
+# ==========================================
+# 表の行の組み立て（列単位でまとめて整形）
+# ==========================================
+TABLE_HEADER = ['台番', '機種名', 'ゲーム数', 'BIG', 'REG', 'AT', '差枚数']
+
+def _int_column(frame, col):
+    # 任意列（G数・BB・RB・ART）が無いCSVでも行ごとに判定せず、列単位で 0 埋めする
+    if col is None or col not in frame.columns:
+        return pd.Series(0, index=frame.index, dtype='int64')
+    return pd.to_numeric(frame[col], errors='coerce').fillna(0).astype('int64')
+
+def _comma(s):
+    return s.astype(str).str.replace(r'(\d)(?=(\d{3})+$)', r'\1,', regex=True)
+
+# CSVの機種名に対応する表示名は、CSVごとに1回、カテゴリ（機種名の種類）単位で求める。
+# CSVの表はセッション間で共有しているので書き換えず、(置換辞書の版, 表示名の Series) の組を
+# bundle["display_names"] に持つ。置換辞書が読み直されたら、次に使うときに作り直して組ごと差し替える
+def _build_display_names(df, col_m_name, table):
+    names = df[col_m_name]
+    display = np.array([lookup_rename(table, str(c)) for c in names.cat.categories], dtype=object)
+    codes = names.cat.codes.to_numpy()
+    categories = display
+    if len(display):
+        # 別々の機種名が同じ表示名になることがあるので、表示名の種類でカテゴリを作り直す
+        categories, inverse = np.unique(display, return_inverse=True)
+        codes = np.where(codes >= 0, inverse[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=df.index)
+
+def display_names(bundle):
+    """CSVの各行の表示名（df と同じ index のカテゴリ型 Series）"""
+    table = get_rename_table()
+    cached = bundle.get("display_names")
+    if cached is None or cached[0] != table["version"]:
+        cached = (table["version"], _build_display_names(bundle["df"], bundle["cols"]["m_name"], table))
+        bundle["display_names"] = cached
+    return cached[1]
+
+def build_table_rows(frame, col_number, col_diff, names):
+    """frame の各行を表の行（台番 / 機種名 / ゲーム数 / BIG / REG / AT / 差枚数）に変換する。
+    names は表示する機種名の Series、または全行共通の表示名。"""
+    if frame.empty:
+        return []
+    if isinstance(names, str):
+        names = pd.Series(names, index=frame.index)
+    diff = _int_column(frame, col_diff)
+    cols = [
+        _int_column(frame, col_number).astype(str),
+        names.astype(str),
+        _comma(_int_column(frame, 'G数')) + "G",
+        _int_column(frame, 'BB').astype(str),
+        _int_column(frame, 'RB').astype(str),
+        _int_column(frame, 'ART').astype(str),
+        pd.Series(np.where(diff >= 0, "+", ""), index=frame.index) + _comma(diff) + "枚",
+    ]
+    return np.column_stack([c.to_numpy(dtype=object) for c in cols]).tolist()
+
+# --- 看板作成 ---
+# 描画済みの看板はキャッシュから返す（共有オブジェクトなので書き換えないこと）
+def create_banner(text, bg_color, banner_height, font_size, y_offset, stroke_width, width):
+    key = (text, bg_color, banner_height, font_size, y_offset, stroke_width, width, font_p)
+    with profile_stage("banner", chars=len(text), width=width) as p:
+        hits = get_banner_cache().hits
+        img = get_banner_cache().get_or_create(
+            key, lambda: _draw_banner(text, bg_color, banner_height, font_size, y_offset, stroke_width, width))
+        p.info["cached"] = get_banner_cache().hits > hits
+    return img
+
+def _draw_banner(text, bg_color, banner_height, font_size, y_offset, stroke_width, width):
+    height = banner_height
+    radius = 45
+    image = Image.new("RGBA", (width, height), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(image)
+    draw.rounded_rectangle([(0, 0), (width, height)], radius=radius, fill=bg_color)
+    font = load_font(font_size, text)
+    bbox = draw.textbbox((0, 0), text, font=font, stroke_width=stroke_width)
+    text_w, text_h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    pos_x, pos_y = (width - text_w) / 2, (height - text_h) / 2 - (text_h * 0.1) + y_offset
+    draw.text((pos_x, pos_y), text, fill="white", font=font, stroke_width=stroke_width)
+    return image
+
+# ==========================================
+# 表の描画
+# ==========================================
+# "pillow": ImageDraw で直接描画（既定） / "matplotlib": 旧描画（比較用）
+TABLE_RENDERER = os.environ.get("TABLE_RENDERER", "pillow")
+
+TABLE_COL_WIDTHS = [0.1, 0.2, 0.15, 0.1, 0.1, 0.1, 0.25]
+TABLE_DPI = 150
+TABLE_WIDTH_INCH = 14
+ROW_H_INCH = 0.85
+SPACER_H_FRAC = 0.01   # 区切り行の高さ（図全体の高さに対する比率）
+EDGE_WIDTH = 2         # 罫線 1pt @150dpi
+
+def _is_spacer(row):
+    return row == [""] * 7
+
+def draw_table_matplotlib(master_rows, h_idx, color):
+    plt, prop = get_pyplot()
+    num_rows = len(master_rows)
+    fig, ax = plt.subplots(figsize=(TABLE_WIDTH_INCH, num_rows * ROW_H_INCH))
+
+    # 余白設定も念のため維持
+    fig.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    ax.axis('off')
+    ax.set_position([0, 0, 1, 1])
+
+    table = ax.table(cellText=master_rows, colWidths=TABLE_COL_WIDTHS, loc='center', cellLoc='center')
+    table.auto_set_font_size(False)
+
+    for (r, c), cell in table.get_celld().items():
+        cell.set_height(1.0 / num_rows)
+        txt = cell.get_text()
+        txt.set_fontproperties(prop)
+        txt.set_verticalalignment('center_baseline')
+        txt.set_horizontalalignment('center')
+
+        if r in h_idx:
+            cell.set_facecolor(color); cell.set_edgecolor(color)
+            txt.set_color('black'); txt.set_fontsize(24); txt.set_weight('bold')
+            if c == 3: txt.set_text(master_rows[r][0])
+            else: txt.set_text("")
+
+            if c == 0: cell.visible_edges = 'TLB'
+            elif c == 6: cell.visible_edges = 'TRB'
+            else: cell.visible_edges = 'TB'
+
+        elif (r-1) in h_idx:
+            cell.set_facecolor('#333333'); txt.set_color('white'); txt.set_fontsize(18)
+
+        elif _is_spacer(master_rows[r]):
+            cell.set_height(SPACER_H_FRAC); cell.visible_edges = ''
+
+        else:
+            cell.set_facecolor('#F9F9F9' if r % 2 == 0 else 'white'); txt.set_fontsize(24)
+
+    buf = io.BytesIO()
+    with profile_stage("table_savefig", rows=num_rows) as p:
+        plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0, dpi=TABLE_DPI, transparent=True)
+        p.info["png_bytes"] = buf.tell()
+    t_img = Image.open(buf).convert('RGBA')
+    plt.close(fig)
+
+    # 表上部の透明ピクセル行を自動削除
+    with profile_stage("table_alpha_crop", px=t_img.width * t_img.height):
+        arr = np.array(t_img)
+        non_empty_rows = np.where(np.any(arr[:, :, 3] > 10, axis=1))[0]
+        if len(non_empty_rows) > 0 and non_empty_rows[0] > 0:
+            t_img = t_img.crop((0, non_empty_rows[0], t_img.width, t_img.height))
+    return t_img
+
+def _draw_cell_text(draw, text, cx, cy, font, fill):
+    # matplotlib の 'center_baseline' 相当：ベースラインから文字上端までの中央をセル中央に合わせる
+    top = draw.textbbox((0, 0), text, font=font, anchor="ls")[1]
+    draw.text((cx, cy - top / 2), text, font=font, fill=fill, anchor="ms")
+
+# 表の本体（罫線・セルの塗り・文字）は行の内容だけで決まるのでキャッシュし、
+# 見出し帯の色は後から塗る。見出し帯は仮の色で描いておき、その画素を指定色で塗り替える
+TABLE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+HEADER_SENTINEL = (1, 2, 3, 254)  # 表の他の部分には現れない色（半透明なので文字や塗りと重ならない）
+
+def _table_layer_nbytes(layer):
+    body, bands, _ = layer
+    return _image_nbytes(body) + sum(_image_nbytes(mask) for _, mask in bands)
+
+_table_cache = LRUCache(256, max_bytes=TABLE_CACHE_MAX_BYTES, sizeof=_table_layer_nbytes)
+
+def get_table_cache():
+    return _table_cache
+
+def _table_image_height(fig_h, table_h):
+    """draw_table_matplotlib の出力と同じ画像の高さ（px）。
+    表が図に収まるときは図の中央に置いて上側だけを切り取るため、下側に同じ幅の透明な余白が残る。
+    区切り行（図の高さに比例）が多くて表が図からはみ出すときは、bbox_inches='tight' で表全体の高さになる"""
+    if table_h >= fig_h:
+        return int(table_h)
+    # 切り取りは上端の罫線の外側で止まるので、罫線の太さの分だけ高くなる
+    return int(round(table_h + (fig_h - table_h) / 2 + EDGE_WIDTH))
+
+def _draw_table_body(master_rows, h_idx):
+    """見出し帯を仮の色で、見出しの文字を抜いて描いた表と、見出し帯ごとの (範囲, 仮の色の画素のマスク)、
+    見出しの文字の描画位置を返す。レイアウトは draw_table_matplotlib と同じ。"""
+    num_rows = len(master_rows)
+    row_h = ROW_H_INCH * TABLE_DPI
+    fig_h = num_rows * row_h
+    width = TABLE_WIDTH_INCH * TABLE_DPI
+    heights = [SPACER_H_FRAC * fig_h if (r not in h_idx and (r - 1) not in h_idx and _is_spacer(row)) else row_h
+               for r, row in enumerate(master_rows)]
+    table_h = sum(heights)
+    height = _table_image_height(fig_h, table_h)
+
+    xs = [0.0]
+    for w in TABLE_COL_WIDTHS: xs.append(xs[-1] + w * width)
+    # 外枠の罫線が画像の外にはみ出さないよう右端・下端は 1px 内側に寄せる
+    xs = [min(int(round(x)), width - 1) for x in xs]
+
+    cell_text = "".join(str(v) for row in master_rows for v in row)
+    font_l = load_font(24 * TABLE_DPI / 72, cell_text)
+    font_s = load_font(18 * TABLE_DPI / 72, cell_text)
+
+    img = Image.new("RGBA", (width, height), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img)
+    color = HEADER_SENTINEL
+    half = EDGE_WIDTH / 2
+    titles = []
+    band_rows = []
+    y = 0.0
+    # matplotlib と同じく行優先でセルごとに「塗り→罫線→文字」の順に描く（はみ出した文字は右隣のセルに隠れる）
+    for r, row in enumerate(master_rows):
+        y0, y1 = int(round(y)), min(int(round(y + heights[r])), height - 1)
+        y += heights[r]
+        for c in range(7):
+            x0, x1 = xs[c], xs[c + 1]
+            top = [(x0, y0 - half), (x1, y0 + half)]
+            bottom = [(x0, y1 - half), (x1, y1 + half)]
+            if r in h_idx:
+                if c == 0:
+                    band_rows.append((max(y0 - EDGE_WIDTH, 0), min(y1 + EDGE_WIDTH, height)))
+                # visible_edges の塗り方に合わせる: TLB は左上の三角形、TB は塗りなし、TRB は全面
+                if c == 0:
+                    draw.polygon([(x0, y0), (x1, y0), (x0, y1)], fill=color)
+                elif c == 6:
+                    draw.rectangle([x0, y0, x1, y1], fill=color)
+                draw.rectangle(top, fill=color); draw.rectangle(bottom, fill=color)
+                if c == 0: draw.rectangle([(x0 - half, y0), (x0 + half, y1)], fill=color)
+                if c == 6: draw.rectangle([(x1 - half, y0), (x1 + half, y1)], fill=color)
+                if c == 3:
+                    # 見出しの文字は右端のセル（全面塗り）より先に描かれ、はみ出した部分はそこで隠れる
+                    titles.append((str(row[0]), (x0 + x1) / 2, (y0 + y1) / 2, (xs[6], y0, width, y1 + 1)))
+                continue
+            if (r - 1) in h_idx:
+                face, fill, font = '#333333', "white", font_s
+            elif _is_spacer(row):
+                continue
+            else:
+                face, fill, font = ('#F9F9F9' if r % 2 == 0 else 'white'), "black", font_l
+            draw.rectangle([x0, y0, x1, y1], fill=face)
+            draw.rectangle([(x0 - half, y0 - half), (x1 + half, y1 + half)], outline="black", width=EDGE_WIDTH)
+            if row[c] != "":
+                _draw_cell_text(draw, str(row[c]), (x0 + x1) / 2, (y0 + y1) / 2, font, fill)
+    # 仮の色は見出し行の上下の罫線の幅までにしか現れないので、その帯だけマスクを持つ
+    arr = np.asarray(img)
+    bands = []
+    for top, bottom in band_rows:
+        hit = (arr[top:bottom] == HEADER_SENTINEL).all(axis=2)
+        bands.append(((0, top, width, bottom), Image.fromarray(np.where(hit, 255, 0).astype(np.uint8), "L")))
+    return img, bands, titles
+
+def _profiled_table_body(master_rows, h_idx):
+    with profile_stage("table_body", rows=len(master_rows)):
+        return _draw_table_body(master_rows, h_idx)
+
+def draw_table_pillow(master_rows, h_idx, color):
+    """draw_table_matplotlib と同じレイアウトを ImageDraw で直接描画する（PNG往復・透明行の走査なし）。
+    表の本体は行の内容ごとにキャッシュし、色を変えただけなら見出し帯の塗りと見出しの文字だけを描く。"""
+    key = (tuple(tuple(str(v) for v in row) for row in master_rows), tuple(h_idx), font_p)
+    body, bands, titles = _table_cache.get_or_create(key, lambda: _profiled_table_body(master_rows, h_idx))
+    img = body.copy()
+    for box, mask in bands:
+        img.paste(color, box, mask)
+    draw = ImageDraw.Draw(img)
+    font_l = load_font(24 * TABLE_DPI / 72, "".join(t[0] for t in titles))
+    for text, cx, cy, hidden in titles:
+        keep = img.crop(hidden)
+        _draw_cell_text(draw, text, cx, cy, font_l, "black")
+        img.paste(keep, hidden[:2])
+    return img
+
+def render_table(master_rows, h_idx, color):
+    with profile_stage("table", renderer=TABLE_RENDERER, rows=len(master_rows)) as p:
+        if TABLE_RENDERER == "matplotlib":
+            img = draw_table_matplotlib(master_rows, h_idx, color)
+        else:
+            img = draw_table_pillow(master_rows, h_idx, color)
+        p.info["px"] = [img.width, img.height]
+    return img
+
+# --- レポートの合成 ---
+# レポートは「看板＋(機種画像＋表)の並び」。パーツは (機種画像のハッシュ, 表の行, 見出し行の位置)
+REPORT_GAP = 25        # 看板・画像・表の間の隙間（表のグループ区切り行と同程度）
+REPORT_PADDING = 40
+BANNER_HEIGHT = 200
+
+def compose_report_page(parts, color, b_text):
+    """看板とパーツを縦に並べた1枚の画像を作る。
+    最終的な大きさ（余白込み）のキャンバスを先に作り、そこへ直接貼り込む（全体の切り抜きや余白付きの複製は作らない）。"""
+    with profile_stage("compose", parts=len(parts)) as p:
+        table_imgs = [render_table(rows, h_idx, color) for _, rows, h_idx in parts]
+        canvas_w = max(t.width for t in table_imgs)
+        layers = [create_banner(b_text, color, BANNER_HEIGHT, 100, -23, 2, canvas_w)]
+        for (digest, _, _), t_img in zip(parts, table_imgs):
+            if t_img.width != canvas_w:
+                with profile_stage("table_resize", px=[t_img.width, t_img.height]):
+                    t_img = t_img.resize((canvas_w, int(t_img.height * canvas_w / t_img.width)), Image.LANCZOS)
+            try:
+                mach_img = get_resized_image(digest, canvas_w)
+                if mach_img:
+                    layers.append(mach_img)
+            except:
+                pass
+            layers.append(t_img)
+        with profile_stage("compose_paste", layers=len(layers)):
+            height = sum(l.height for l in layers) + REPORT_GAP * (len(layers) - 1)
+            canvas = Image.new("RGBA", (canvas_w + REPORT_PADDING * 2, height + REPORT_PADDING * 2), (255, 255, 255, 255))
+            y = REPORT_PADDING
+            for l in layers:
+                canvas.paste(l, (REPORT_PADDING, y), l)
+                y += l.height + REPORT_GAP
+        p.info["px"] = [canvas.width, canvas.height]
+    return canvas
+
+# --- レポート生成用描画関数 (B案：物理オーバーラップ版) ---
+def draw_table_image(master_rows, h_idx, color, b_text, suffix):
+    return compose_report_page([(None, master_rows, h_idx)], color, b_text)
+
+# --- 仕掛けテーブルのみ描画（バナーなし・パディングなし）---
+def draw_shikake_table_only(master_rows, h_idx, color):
+    return render_table(master_rows, h_idx, color)
+
+# --- 機種単体テーブル描画（バナーなし）---
+def draw_machine_table(rows, color):
+    return render_table(rows, [0], color)
+
+# --- 機種画像付きレポート生成（レポート1/2/4用）---
+def draw_report_with_machine_images(machine_sections, color, b_text, images_dict=None):
+    return compose_report_page([((images_dict or {}).get(dn), rows, [0]) for dn, rows in machine_sections],
+                               color, b_text)
+
+# ==========================================
+# ページ分割（縦に長いレポート）
+# ==========================================
+# page は {"max_height": 1ページの高さの上限（px・余白込み）, "max_rows": 1ページの表の行数の上限} の一方か両方。
+# 表が途中で分かれるときは、続きのページにそのグループの見出し行と列名の行を付け直す
+PAGE_SPLITS = {"しない": None, "高さ 4000px ごと": {"max_height": 4000}, "高さ 2500px ごと": {"max_height": 2500},
+               "30行ごと": {"max_rows": 30}}
+
+def _table_height(n_rows, n_spacers):
+    """行数と区切り行の数から表の画像の高さを見積もる（_draw_table_body と同じ計算）"""
+    row_h = ROW_H_INCH * TABLE_DPI
+    fig_h = n_rows * row_h
+    table_h = (n_rows - n_spacers) * row_h + n_spacers * SPACER_H_FRAC * fig_h
+    return _table_image_height(fig_h, table_h)
+
+def _split_table(rows, h_idx, fits):
+    """表の行を先頭から fits(行数, 区切り行数) が許す所まで取り、(このページの行, 見出し位置, 残りの行, 残りの見出し位置) を返す。
+    見出し行・列名の行だけでページが終わらないようにし、少なくとも1行のデータは取る（取れなければ None）。"""
+    heads = set(h_idx)
+    n_spacers = 0
+    cut = None
+    for i, row in enumerate(rows):
+        if i not in heads and (i - 1) not in heads and _is_spacer(row):
+            n_spacers += 1
+        if not fits(i + 1, n_spacers):
+            break
+        if i not in heads and (i - 1) not in heads:
+            cut = i + 1
+    if cut is None:
+        return None
+    page_rows, page_idx = rows[:cut], [h for h in h_idx if h < cut]
+    rest = rows[cut:]
+    # 続きがグループの途中から始まるなら、そのグループの見出し行と列名の行を付け直す
+    while rest and _is_spacer(rest[0]) and cut not in heads:
+        rest, cut = rest[1:], cut + 1
+    rest_idx = [h - cut for h in h_idx if h >= cut]
+    if rest and cut not in heads:
+        g = max(h for h in h_idx if h < cut)
+        rest = [rows[g], rows[g + 1]] + rest
+        rest_idx = [0] + [h + 2 for h in rest_idx]
+    return page_rows, page_idx, rest, rest_idx
+
+def paginate_parts(parts, page):
+    """パーツの並びをページごとのパーツの並びに分ける（1ページ＝看板＋その下に並ぶパーツ）。
+    表の画像は描かず、行数と機種画像の大きさから高さを見積もって分ける。"""
+    max_h = page.get("max_height") or float("inf")
+    max_rows = page.get("max_rows") or float("inf")
+    width = TABLE_WIDTH_INCH * TABLE_DPI
+    base_h = REPORT_PADDING * 2 + BANNER_HEIGHT
+    pages, cur, used_h, used_rows = [], [], base_h, 0
+    for digest, rows, h_idx in parts:
+        try:
+            mach_img = get_resized_image(digest, width)
+            img_h = mach_img.height + REPORT_GAP if mach_img else 0
+        except:
+            img_h = 0
+        while rows:
+            def fits(n, n_spacers, h0=used_h + img_h, r0=used_rows):
+                return h0 + REPORT_GAP + _table_height(n, n_spacers) <= max_h and r0 + n <= max_rows
+            split = _split_table(rows, h_idx, fits)
+            if split is None and cur:
+                # このページには入らないので次のページから
+                pages.append(cur)
+                cur, used_h, used_rows = [], base_h, 0
+                continue
+            if split is None:
+                # 空のページにも収まらない（上限が小さすぎる）ときは、最初のデータ行までで1ページにする
+                heads = set(h_idx)
+                first = next((i for i in range(len(rows)) if i not in heads and (i - 1) not in heads), len(rows))
+                split = _split_table(rows, h_idx, lambda n, s: n <= first + 1) or (rows, h_idx, [], [])
+            page_rows, page_idx, rows, h_idx = split
+            cur.append((digest, page_rows, page_idx))
+            used_h += img_h + REPORT_GAP + _table_height(len(page_rows), sum(
+                1 for i, r in enumerate(page_rows) if i not in page_idx and (i - 1) not in page_idx and _is_spacer(r)))
+            used_rows += len(page_rows)
+            digest, img_h = None, 0  # 機種画像は表の最初のページにだけ付ける
+    if cur:
+        pages.append(cur)
+    return pages
+
+def iter_report_pages(sid, bundle, spec, page):
+    """レポート sid をページごとの画像として1枚ずつ返すジェネレーター。
+    各ページは最終的な大きさのキャンバスに直接描くので、メモリの使用量はページの大きさで決まる。"""
+    parts = build_report_parts(sid, bundle, spec)
+    for page_parts in paginate_parts(parts, page):
+        yield compose_report_page(page_parts, spec["color"], spec["text"])
+
+def write_report_pages_zip(pages, fileobj, stem, fmt="PNG", **settings):
+    """ページの画像を1枚ずつエンコードして ZIP に書き込み、ページ数を返す（書き終えたページは手放す）"""
+    ext = OUTPUT_FORMATS[fmt][0]
+    n = 0
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_STORED) as zf:
+        for n, img in enumerate(pages, 1):
+            zf.writestr(f"{stem}_p{n:02d}.{ext}", encode_report_image(img, fmt, **settings))
+    return n
+
+# ==========================================
+# 日ごとの履歴（history_store）
+# ==========================================
+HISTORY_COLUMNS = ['台番', '機種名', 'G数', 'BB', 'RB', 'ART', '差枚']
+
+def _history_values(frame, col):
+    if col is None or col not in frame.columns:
+        return [None] * len(frame)
+    return [None if pd.isna(v) else int(v) for v in pd.to_numeric(frame[col], errors='coerce').tolist()]
+
+def history_records(bundle):
+    """CSVの各行を履歴に入れる (台番, 機種名, G数, BB, RB, ART, 差枚) に変換する"""
+    df, cols = bundle["df"], bundle["cols"]
+    numbers = pd.to_numeric(df[cols["number"]], errors='coerce')
+    frame = df[numbers.notna() & df[cols["m_name"]].notna()]
+    return list(zip(_history_values(frame, cols["number"]), frame[cols["m_name"]].astype(str).tolist(),
+                    *(_history_values(frame, c) for c in CSV_OPTIONAL_COLUMNS),
+                    _history_values(frame, cols["diff"])))
+
+def add_to_history(bundle, csv_digest, source, day=None):
+    """CSVを履歴に取り込み、(営業日, 結果) を返す。
+    営業日は 取り込み済みならその日 → day → ファイル名の日付 → 今日 の順に決める。"""
+    known = history_store.day_of_digest(csv_digest)
+    if known and day is None:
+        return known, "same_csv"
+    day = day or history_store.day_from_filename(source) or datetime.date.today()
+    return day, history_store.add_day(day, csv_digest, source, history_records(bundle))
+
+def window_range(window):
+    end = window["end"]
+    return end - datetime.timedelta(days=window["days"] - 1), end
+
+def build_window_sections(targets, window):
+    """レポート1/2（期間集計）：履歴から期間内の合計で「◯◯ 優秀台」の表の行を作る。
+    mode が "total" なら合計差枚が枚数以上の台、"days" なら差枚が枚数以上だった日が min_days 日以上の台。"""
+    start, end = window_range(window)
+    sections = []
+    for cn, dn, thr in targets:
+        agg = history_store.aggregate_machine(cn, start, end, thr)
+        if window.get("mode") == "days":
+            hit = [r for r in agg if r[7] >= window.get("min_days", 1)]
+        else:
+            hit = [r for r in agg if r[6] is not None and r[6] >= thr]
+        if not hit:
+            continue
+        frame = pd.DataFrame([(r[0], cn) + tuple(r[2:7]) for r in hit], columns=HISTORY_COLUMNS)
+        rows = [[f"{dn} 優秀台"] * 7, list(TABLE_HEADER)]
+        rows.extend(build_table_rows(frame, '台番', '差枚', dn))
+        sections.append((dn, rows))
+    return sections
+
+# ==========================================
+# レポートの組み立て
+# ==========================================
+def build_machine_sections(bundle, targets):
+    """レポート1/2/4：対象機種ごとに「◯◯ 優秀台」の表の行を作る"""
+    cols = bundle["cols"]
+    sections = []
+    for dn, e_df in select_targets(bundle["machine_index"], targets, cols["number"]):
+        rows = [[f"{dn} 優秀台"] * 7, list(TABLE_HEADER)]
+        rows.extend(build_table_rows(e_df, cols["number"], cols["diff"], dn))
+        sections.append((dn, rows))
+    return sections
+
+def build_shikake_rows(bundle, contents, specs):
+    """レポート3：仕掛けごとの内容と (台番リスト, 指定式) から表の行を作る。
+    戻り値は (行, 見出し行の位置, 仕掛けごとの解釈できなかった指定)。"""
+    df, cols, names = bundle["df"], bundle["cols"], display_names(bundle)
+    master_rows, h_idx, unresolved_all = [], [], []
+    for content, (positions, unresolved) in zip(contents, resolve_shikake(bundle["number_index"], specs)):
+        unresolved_all.append(unresolved)
+        if not content or len(positions) == 0:
+            continue
+        m_df = df.iloc[positions].sort_values(cols["number"])
+        h_idx.append(len(master_rows))
+        master_rows.append([content] * 7)
+        master_rows.append(list(TABLE_HEADER))
+        master_rows.extend(build_table_rows(m_df, cols["number"], cols["diff"], names.loc[m_df.index]))
+        master_rows.append([""] * 7)
+    return master_rows, h_idx, unresolved_all
+
+# --- 仕掛けレポート（看板＋先頭機種の画像＋表）---
+def draw_shikake_report(master_rows, h_idx, color, b_text, image_digest=None):
+    return compose_report_page([(image_digest, master_rows, h_idx)], color, b_text)
+
+def build_top10_rows(bundle, title):
+    """レポート5：差枚数の上位10台"""
+    df, cols = bundle["df"], bundle["cols"]
+    top10_df = df.sort_values(by=cols["diff"], ascending=False).head(10)
+    master_rows = [[f"{title}"] * 7, list(TABLE_HEADER)]
+    master_rows.extend(build_table_rows(top10_df, cols["number"], cols["diff"], display_names(bundle).loc[top10_df.index]))
+    return master_rows, [0]
+
+def build_report_parts(sid, bundle, spec):
+    """レポート sid のパーツ (機種画像のハッシュ, 表の行, 見出し行の位置) の並びを作る。
+    spec は看板の文字・色・対象機種・画像・仕掛けをまとめた辞書。対象が1台も無ければ空。"""
+    images = spec.get("images") or {}
+    if sid in ("1", "2", "4"):
+        window = spec.get("window")
+        if window and window["days"] > 1:
+            sections = build_window_sections(spec["targets"], window)
+        else:
+            sections = build_machine_sections(bundle, spec["targets"])
+        return [(images.get(dn), rows, [0]) for dn, rows in sections]
+    if sid == "3":
+        master_rows, h_idx, _ = build_shikake_rows(bundle, spec["shikake_contents"], spec["shikake_specs"])
+        if not master_rows:
+            return []
+        targets = spec.get("targets") or []
+        return [(images.get(targets[0][1]) if targets else None, master_rows, h_idx)]
+    master_rows, h_idx = build_top10_rows(bundle, spec["text"])
+    return [(None, master_rows, h_idx)]
+
+def render_report(sid, bundle, spec):
+    """レポート sid を1枚の画像に描画する。対象が1台も無ければ None を返す。"""
+    with profile_stage("report", sid=sid) as p:
+        parts = build_report_parts(sid, bundle, spec)
+        p.info["parts"] = len(parts)
+        return compose_report_page(parts, spec["color"], spec["text"]) if parts else None
+
+def render_report_from_csv(sid, data, digest, spec):
+    """プロセスプールから呼ぶ入口。CSVの中身を受け取り、ワーカー側で読み込んで描画する。
+    画像はレポートの保管場所（ディスク）に置き、そのハッシュを返す（対象が無ければ None）"""
+    img = render_report(sid, get_csv_bundle(data, digest), spec)
+    return put_report_image(img, keep_in_memory=False) if img is not None else None
+
+# ==========================================
+# 書き出し（投稿用の画像ファイル）
+# ==========================================
+# 形式名 → (拡張子, MIMEタイプ)
+OUTPUT_FORMATS = {"PNG": ("png", "image/png"), "WebP": ("webp", "image/webp"), "JPEG": ("jpg", "image/jpeg")}
+
+def encode_report_image(img, fmt="PNG", width=None, compress_level=6, quantize=False, quality=90):
+    """レポート画像をファイルの中身（bytes）に変換する。
+    width を指定すると縦横比を保って縮小する。quantize は PNG を256色のパレットにする
+    （表は単色の塗りが中心なので見た目はほぼ変わらず、ファイルが小さくなる）。"""
+    with profile_stage("encode", fmt=fmt, px=[img.width, img.height]) as p:
+        if width and width < img.width:
+            with profile_stage("encode_resize", width=width):
+                img = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+        buf = io.BytesIO()
+        if fmt == "PNG":
+            if quantize:
+                img = img.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+            img.save(buf, format="PNG", compress_level=compress_level)
+        elif fmt == "WebP":
+            img.save(buf, format="WEBP", quality=quality, method=4)
+        elif fmt == "JPEG":
+            # JPEG は透過できないので白で埋める
+            rgb = Image.new("RGB", img.size, "white")
+            rgb.paste(img, mask=img.getchannel("A") if img.mode == "RGBA" else None)
+            rgb.save(buf, format="JPEG", quality=quality, optimize=True)
+        else:
+            raise ValueError(f"未対応の形式です: {fmt}")
+        p.info["bytes"] = buf.tell()
+    return buf.getvalue()
+
+# --- 生成したレポート画像の保管（全セッション共有）---
+# セッションには内容のハッシュだけを持たせ、画像は PNG にしてここに置く。
+# メモリは合計サイズの上限を超えたら古いものから捨て、捨てたものはディスクから読み直す
+REPORT_STORE_DIR = os.path.join(".cache", "reports")
+REPORT_MEMORY_MAX_BYTES = 128 * 1024 * 1024
+REPORT_DISK_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_OUTPUT = {"fmt": "PNG", "width": None, "compress_level": 6, "quantize": False, "quality": 90}
+
+# キー: (ハッシュ, None) が保管した PNG、(ハッシュ, 書き出し設定…) がその設定で変換したもの
+_report_cache = LRUCache(1024, max_bytes=REPORT_MEMORY_MAX_BYTES, sizeof=lambda b: len(b) if b else 0)
+
+def get_report_cache():
+    return _report_cache
+
+def _report_path(digest):
+    return os.path.join(REPORT_STORE_DIR, f"{digest}.png")
+
+def put_report_image(img, keep_in_memory=True):
+    """レポート画像を PNG にして保管し、ハッシュを返す。
+    ワーカープロセスからはディスクにだけ置けばよいので keep_in_memory=False で呼ぶ。"""
+    data = encode_report_image(img)
+    digest = hashlib.sha256(data).hexdigest()
+    path = _report_path(digest)
+    if not _touch(path):
+        os.makedirs(REPORT_STORE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        _evict_disk_lru(REPORT_STORE_DIR, REPORT_DISK_MAX_BYTES)
+    if keep_in_memory:
+        _report_cache.put((digest, None), data)
+    return digest
+
+def _read_report_file(digest):
+    path = _report_path(digest)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        _touch(path)
+        return data
+    except OSError:
+        return None
+
+def get_report_bytes(digest, settings=None):
+    """保管したレポートを書き出し設定 settings の形式で返す（既定の設定なら保管した PNG そのもの）。
+    ディスクからも消えていれば None。"""
+    if not digest:
+        return None
+    master = _report_cache.get_or_create((digest, None), lambda: _read_report_file(digest))
+    if master is None or not settings or settings == DEFAULT_OUTPUT:
+        return master
+    key = (digest,) + tuple(sorted(settings.items()))
+    return _report_cache.get_or_create(key, lambda: encode_report_image(Image.open(io.BytesIO(master)), **settings))
+
+# 配信用に書き出した画像（内容のハッシュをファイル名にする）
+PUBLISH_DISK_MAX_BYTES = 256 * 1024 * 1024
+
+def publish_report_bytes(data, ext, publish_dir):
+    """エンコード済みの画像を publish_dir に置き、ファイル名（sha256.拡張子）を返す。
+    同じ内容なら書き直さないので、何度呼んでも同じ名前になる。"""
+    with profile_stage("publish", bytes=len(data)) as p:
+        name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+        path = os.path.join(publish_dir, name)
+        p.info["cached"] = _touch(path)
+        if p.info["cached"]:
+            return name
+        os.makedirs(publish_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        _evict_disk_lru(publish_dir, PUBLISH_DISK_MAX_BYTES)
+    return name
+
+def load_report_spec(sid, shikake_selectors=None):
+    """保存済みのファイルからレポートの設定を読む（一括出力用。背景色は既定色）"""
+    cfg = FILES[sid]
+    spec = {
+        "text": load_banner_text(sid),
+        "color": cfg["color"],
+        "targets": load_targets(sid),
+        "images": load_images(sid),
+    }
+    if sid == "3":
+        spec["shikake_contents"] = load_shikake_content()
+        spec["shikake_specs"] = [([], expr) for expr in (shikake_selectors or [""] * 7)]
+    return spec
+
+startup_times["import"] = time.perf_counter() - _import_started
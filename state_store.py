@@ -0,0 +1,162 @@
+"""設定の保存先（SQLite・WAL モード）
+
+看板の文字・対象機種・機種画像の対応表・入力フォームの状態・仕掛けの内容を1つの DB にまとめる。
+書き込みは行単位のトランザクションで行い、書き込むたびに revision を1つ進める。
+読み込みはプロセス内で1回だけ行って保持し、revision が変わったときだけ読み直す
+（他のセッションや他のプロセスが書き込んだ内容もそこで反映される）。
+"""
+import json
+import os
+import sqlite3
+import threading
+
+DB_FILE = "app_state.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS banners (sid TEXT PRIMARY KEY, text TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS targets (
+    sid TEXT NOT NULL, pos INTEGER NOT NULL,
+    csv_name TEXT NOT NULL, display_name TEXT NOT NULL, threshold INTEGER NOT NULL,
+    PRIMARY KEY (sid, pos)
+);
+CREATE TABLE IF NOT EXISTS images (
+    sid TEXT NOT NULL, display_name TEXT NOT NULL, digest TEXT NOT NULL,
+    PRIMARY KEY (sid, display_name)
+);
+CREATE TABLE IF NOT EXISTS form_state (sid TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS shikake (slot INTEGER PRIMARY KEY, content TEXT NOT NULL);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', '0');
+"""
+
+SHIKAKE_SLOTS = 7
+
+_local = threading.local()
+_lock = threading.Lock()
+_snapshot = None
+_snapshot_rev = None
+
+def _connect():
+    """スレッドごとに接続を1つ持つ（sqlite3 の接続はスレッドをまたいで使えない）"""
+    conn = getattr(_local, "conn", None)
+    # fork した子プロセスでは親の接続を使わない（SQLite の接続はプロセスをまたげない）
+    if conn is None or getattr(_local, "db_file", None) != DB_FILE or getattr(_local, "pid", None) != os.getpid():
+        conn = sqlite3.connect(DB_FILE, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn, _local.db_file, _local.pid = conn, DB_FILE, os.getpid()
+    return conn
+
+class _write:
+    """書き込み用のトランザクション。抜けるときに revision を進めてコミットする"""
+    def __enter__(self):
+        self.conn = _connect()
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'revision'")
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+def revision():
+    return int(_connect().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0])
+
+def _read_all(conn):
+    state = {"banners": {}, "targets": {}, "images": {}, "form_state": {}, "shikake": [""] * SHIKAKE_SLOTS}
+    for sid, text in conn.execute("SELECT sid, text FROM banners"):
+        state["banners"][sid] = text
+    for sid, cn, dn, t in conn.execute("SELECT sid, csv_name, display_name, threshold FROM targets ORDER BY sid, pos"):
+        state["targets"].setdefault(sid, []).append((cn, dn, t))
+    for sid, dn, digest in conn.execute("SELECT sid, display_name, digest FROM images"):
+        state["images"].setdefault(sid, {})[dn] = digest
+    for sid, data in conn.execute("SELECT sid, data FROM form_state"):
+        state["form_state"][sid] = json.loads(data)
+    for slot, content in conn.execute("SELECT slot, content FROM shikake"):
+        if 0 <= slot < SHIKAKE_SLOTS:
+            state["shikake"][slot] = content
+    return state
+
+def snapshot():
+    """保存内容の全体を返す（共有オブジェクトなので書き換えないこと）。
+    前回から revision が変わっていなければ DB は読まない。"""
+    global _snapshot, _snapshot_rev
+    rev = revision()
+    with _lock:
+        if _snapshot is None or rev != _snapshot_rev:
+            conn = _connect()
+            conn.execute("BEGIN")  # 読み込み中に書き込まれても一貫した内容を読む
+            try:
+                _snapshot = _read_all(conn)
+            finally:
+                conn.execute("COMMIT")
+            _snapshot_rev = rev
+        return _snapshot
+
+# ==========================================
+# 書き込み
+# ==========================================
+def set_banner(sid, text):
+    with _write() as conn:
+        conn.execute("INSERT INTO banners (sid, text) VALUES (?, ?) "
+                     "ON CONFLICT(sid) DO UPDATE SET text = excluded.text", (sid, text))
+
+def set_targets(sid, targets):
+    with _write() as conn:
+        conn.execute("DELETE FROM targets WHERE sid = ?", (sid,))
+        conn.executemany("INSERT INTO targets (sid, pos, csv_name, display_name, threshold) VALUES (?, ?, ?, ?, ?)",
+                         [(sid, pos, str(cn), str(dn), int(t)) for pos, (cn, dn, t) in enumerate(targets)])
+
+def set_images(sid, manifest):
+    with _write() as conn:
+        conn.execute("DELETE FROM images WHERE sid = ?", (sid,))
+        conn.executemany("INSERT INTO images (sid, display_name, digest) VALUES (?, ?, ?)",
+                         [(sid, dn, digest) for dn, digest in manifest.items()])
+
+def replace_image_digest(old, new):
+    """対応表の中の画像ハッシュ old を new に置き換える（どのレポート・表示名でも）。置き換えた件数を返す"""
+    with _write() as conn:
+        return conn.execute("UPDATE images SET digest = ? WHERE digest = ?", (new, old)).rowcount
+
+def image_digests():
+    """対応表に載っている画像ハッシュの一覧（重複なし）"""
+    return [d for d, in _connect().execute("SELECT DISTINCT digest FROM images")]
+
+def set_form_state(sid, data):
+    with _write() as conn:
+        conn.execute("INSERT INTO form_state (sid, data) VALUES (?, ?) "
+                     "ON CONFLICT(sid) DO UPDATE SET data = excluded.data", (sid, json.dumps(data, ensure_ascii=False)))
+
+def set_shikake(contents):
+    with _write() as conn:
+        conn.executemany("INSERT INTO shikake (slot, content) VALUES (?, ?) "
+                         "ON CONFLICT(slot) DO UPDATE SET content = excluded.content",
+                         list(enumerate(contents[:SHIKAKE_SLOTS])))
+
+def set_shikake_slot(slot, content):
+    with _write() as conn:
+        conn.execute("INSERT INTO shikake (slot, content) VALUES (?, ?) "
+                     "ON CONFLICT(slot) DO UPDATE SET content = excluded.content", (slot, content))
+
+def import_state(state):
+    """旧形式のファイルから読んだ内容を1つのトランザクションで取り込む（初回起動時）"""
+    with _write() as conn:
+        conn.executemany("INSERT OR REPLACE INTO banners (sid, text) VALUES (?, ?)", state["banners"].items())
+        for sid, targets in state["targets"].items():
+            conn.executemany("INSERT OR REPLACE INTO targets (sid, pos, csv_name, display_name, threshold) VALUES (?, ?, ?, ?, ?)",
+                             [(sid, pos, str(cn), str(dn), int(t)) for pos, (cn, dn, t) in enumerate(targets)])
+        for sid, manifest in state["images"].items():
+            conn.executemany("INSERT OR REPLACE INTO images (sid, display_name, digest) VALUES (?, ?, ?)",
+                             [(sid, dn, digest) for dn, digest in manifest.items()])
+        conn.executemany("INSERT OR REPLACE INTO form_state (sid, data) VALUES (?, ?)",
+                         [(sid, json.dumps(data, ensure_ascii=False)) for sid, data in state["form_state"].items()])
+        conn.executemany("INSERT OR REPLACE INTO shikake (slot, content) VALUES (?, ?)",
+                         list(enumerate(state["shikake"][:SHIKAKE_SLOTS])))
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported', '1')")
+
+def imported():
+    return _connect().execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone() is not None